@@ -5,4 +5,4 @@
 
 cd /app/scoreboard
 . /root/venv/bin/activate
-./loader.py --urlbase 'https://scoreboard.crawl.develz.org' --extra-player-pages 50 && ./update-dms.sh
+./loader.py --urlbase 'https://scoreboard.crawl.develz.org' --extra-player-pages 2000 --player-page-budget 120 && ./update-dms.sh
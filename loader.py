@@ -4,9 +4,13 @@
 import argparse
 import sys
 
+import scoreboard.apiserver
 import scoreboard.log_import
+import scoreboard.model
 import scoreboard.orm
 import scoreboard.scoring
+import scoreboard.snapshot
+import scoreboard.sqlprofile
 import scoreboard.write_website
 
 
@@ -40,6 +44,101 @@ def read_commandline() -> argparse.Namespace:
         '--database-path',
         default='database.db3',
         help='Database path (for sqlite). Default: database.db3')
+    parser.add_argument(
+        '--db-host',
+        default='localhost',
+        help='Database host (for postgres). Default: localhost')
+    parser.add_argument(
+        '--db-port',
+        type=int,
+        default=None,
+        help='Database port (for postgres). Default: driver default')
+    parser.add_argument(
+        '--db-name',
+        default='scoreboard',
+        help='Database name (for postgres). Default: scoreboard')
+    parser.add_argument(
+        '--db-pool-size',
+        metavar='NUM',
+        type=int,
+        default=None,
+        help='Keep up to NUM pooled connections per engine. '
+        'Default: no pooling')
+    parser.add_argument(
+        '--db-max-overflow',
+        metavar='NUM',
+        type=int,
+        default=None,
+        help='Allow NUM connections above the pool size')
+    parser.add_argument(
+        '--db-pool-recycle',
+        metavar='SECS',
+        type=int,
+        default=None,
+        help='Recycle pooled connections older than SECS seconds')
+    parser.add_argument(
+        '--db-pool-pre-ping',
+        action='store_true',
+        help='Check pooled connections are alive before using them')
+    parser.add_argument(
+        '--db-readonly',
+        action='store_true',
+        help='Use a separate read-only connection for website generation')
+    parser.add_argument(
+        '--db-replica',
+        metavar='URI',
+        default=None,
+        help='SQLAlchemy URI of a read replica for website generation '
+        '(implies --db-readonly)')
+    parser.add_argument(
+        '--check-indexes',
+        action='store_true',
+        help="Check the leaderboard queries use the winning game indexes, "
+        "then exit.")
+    parser.add_argument(
+        '--compile-templates',
+        action='store_true',
+        help="Compile the website templates into the template cache, "
+        "then exit.")
+    parser.add_argument(
+        '--serve-api',
+        action='store_true',
+        help="Serve the JSON query API (see scoreboard/apiserver.py) on a "
+        "read-only connection, then exit when interrupted. With postgres, "
+        "also use --db-pool-size.")
+    parser.add_argument(
+        '--api-port',
+        metavar='PORT',
+        default=scoreboard.apiserver.PORT,
+        type=int,
+        help='Port for --serve-api. Default: %(default)s')
+    parser.add_argument(
+        '--api-bind',
+        metavar='ADDRESS',
+        default='',
+        help='Address for --serve-api to listen on. Default: all interfaces')
+    parser.add_argument(
+        '--api-workers',
+        metavar='NUM',
+        default=scoreboard.apiserver.WORKERS,
+        type=int,
+        help='Run --serve-api queries in NUM threads. Default: %(default)s')
+    parser.add_argument(
+        '--export-snapshot',
+        metavar='DIR',
+        default=None,
+        help="Create or refresh a columnar snapshot of all games in DIR, "
+        "for scoreboard.analytics.")
+    parser.add_argument(
+        '--profile-sql',
+        action='store_true',
+        help="Profile SQL statements and print a report at the end.")
+    parser.add_argument(
+        '--profile-sql-top',
+        metavar='NUM',
+        default=10,
+        type=int,
+        help='Show the NUM slowest statements in the SQL profile. Default: 10')
     parser.add_argument(
         '--skip-scoring', action='store_true', help="Skip scoring.")
     parser.add_argument(
@@ -60,6 +159,49 @@ def read_commandline() -> argparse.Namespace:
         type=int,
         help='(Re-)Generate pages for an additional NUM players (least recently updated first)'
     )
+    parser.add_argument(
+        '--player-page-budget',
+        metavar='SECS',
+        default=None,
+        type=float,
+        help='Stop rendering player pages after SECS seconds. Pages with '
+        'new games or record changes which are left are rebuilt first on '
+        'the next run. Default: no limit')
+    parser.add_argument(
+        '--build-report',
+        metavar='FILE',
+        default=scoreboard.write_website.BUILD_REPORT,
+        help='Write a JSON timing report of the website build to FILE. '
+        'Default: %(default)s')
+    parser.add_argument(
+        '--build-history',
+        metavar='FILE',
+        default=None,
+        help='Also append the timing report to FILE, one JSON report per '
+        'line, to track build times over time.')
+    parser.add_argument(
+        '--fragment-cache',
+        metavar='DIR',
+        default=scoreboard.write_website.FRAGMENT_CACHE_DIR,
+        help='Save rendered highscore and streak tables in DIR for later '
+        'builds. Set blank to disable. Default: %(default)s')
+    parser.add_argument(
+        '--render-workers',
+        metavar='NUM',
+        default=1,
+        type=int,
+        help='Render player pages in NUM processes. Default: 1')
+    parser.add_argument(
+        '--precompress',
+        action='store_true',
+        help="Write gzip (and brotli, if installed) copies of changed "
+        "website files, for nginx gzip_static/brotli_static.")
+    parser.add_argument(
+        '--compress-workers',
+        metavar='NUM',
+        default=1,
+        type=int,
+        help='Compress website files in NUM processes. Default: 1')
     parser.add_argument(
         '--db-credentials',
         metavar="user:passwd",
@@ -69,35 +211,93 @@ def read_commandline() -> argparse.Namespace:
     return args
 
 
+def check_indexes() -> None:
+    """Print which leaderboard queries use their partial indexes."""
+    s = scoreboard.orm.get_session()
+    results = scoreboard.model.check_winning_indexes(s)
+    for name, index, used in results:
+        print("%s: %s %s" % (name, index, "used" if used else "NOT USED"))
+    if not all(used for _, _, used in results):
+        error("Some leaderboard queries don't use their indexes.")
+
+
 def main() -> None:
     """Run CLI."""
     args = read_commandline()
 
-    scoreboard.orm.setup_database(
-        database=args.database,
-        path=args.database_path,
-        credentials=args.db_credentials)
+    profiler = scoreboard.sqlprofile.SQLProfiler(top=args.profile_sql_top)
+    if args.profile_sql:
+        profiler.install()
+    try:
+        run(args, profiler)
+    finally:
+        if args.profile_sql:
+            print(profiler.report())
+
+
+def run(args: argparse.Namespace,
+        profiler: scoreboard.sqlprofile.SQLProfiler) -> None:
+    """Run each stage of the scoreboard."""
+    if args.compile_templates:
+        scoreboard.write_website.compile_templates()
+        return
+
+    with profiler.phase('setup'):
+        scoreboard.orm.setup_database(
+            database=args.database,
+            path=args.database_path,
+            credentials=args.db_credentials,
+            host=args.db_host,
+            port=args.db_port,
+            dbname=args.db_name,
+            pool_size=args.db_pool_size,
+            max_overflow=args.db_max_overflow,
+            pool_recycle=args.db_pool_recycle,
+            pool_pre_ping=args.db_pool_pre_ping,
+            readonly=args.db_readonly or args.serve_api,
+            replica_uri=args.db_replica)
+
+    if args.check_indexes:
+        check_indexes()
+        return
+
+    if args.serve_api:
+        scoreboard.apiserver.serve_api(
+            bind=args.api_bind,
+            port=args.api_port,
+            workers=args.api_workers)
+        return
 
     if args.game_api:
-        scoreboard.log_import.load_logfiles(api_url=args.game_api)
+        with profiler.phase('import'):
+            scoreboard.log_import.load_logfiles(api_url=args.game_api)
 
     if not args.skip_scoring:
-        players = scoreboard.scoring.score_games()
-    else:
-        players = None
+        with profiler.phase('scoring'):
+            scoreboard.scoring.score_games()
+
+    if args.export_snapshot:
+        with profiler.phase('snapshot'):
+            scoreboard.snapshot.export_snapshot(args.export_snapshot)
 
     if not args.skip_website:
+        # Players with new games are queued in dirty_pages by scoring
         if args.rebuild_player_pages:
             players = None
-        if args.players:
-            if players:
-                players.update(args.players)
-            else:
-                players = args.players
-        scoreboard.write_website.write_website(
-            urlbase=args.urlbase,
-            players=players,
-            extra_player_pages=args.extra_player_pages)
+        else:
+            players = args.players or []
+        with profiler.phase('website'):
+            scoreboard.write_website.write_website(
+                urlbase=args.urlbase,
+                players=players,
+                extra_player_pages=args.extra_player_pages,
+                render_workers=args.render_workers,
+                precompress=args.precompress,
+                compress_workers=args.compress_workers,
+                page_budget=args.player_page_budget,
+                report_path=args.build_report,
+                history_path=args.build_history,
+                fragment_cache_dir=args.fragment_cache or None)
 
 
 if __name__ == '__main__':
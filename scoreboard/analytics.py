@@ -0,0 +1,194 @@
+"""Site-wide statistics computed from a games snapshot.
+
+All aggregates are vectorised NumPy operations over the memory-mapped
+columns written by snapshot.export_snapshot, so they don't touch the
+database.
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy
+
+from . import snapshot
+
+# Grouping dimensions: name -> (column, dimension table in the manifest)
+GROUPINGS = {
+    'species': ('species_id', 'species'),
+    'background': ('background_id', 'background'),
+    'god': ('god_id', 'god'),
+    'version': ('version_id', 'version'),
+    'ktyp': ('ktyp_id', 'ktyp'),
+    'place': ('place_id', 'place'),
+}
+
+
+class Snapshot:
+    """A loaded games snapshot.
+
+    Attributes:
+        columns: dict of column name -> numpy array
+        dimensions: dict of dimension -> {id: label}
+        rows: number of games
+    """
+
+    def __init__(self, path: str) -> None:
+        columns = snapshot.load_columns(path)
+        manifest = columns.pop('manifest')
+        self.columns = columns
+        self.rows = manifest['rows']  # type: int
+        # JSON object keys are always strings
+        self.dimensions = {
+            dim: {int(k): v
+                  for k, v in labels.items()}
+            for dim, labels in manifest.get('dimensions', {}).items()
+        }  # type: Dict[str, Dict[int, str]]
+
+    def ktyp_id(self, name: str) -> int:
+        """Return the id of a ktyp, or -1 if it's not in the snapshot."""
+        for i, ktyp in self.dimensions['ktyp'].items():
+            if ktyp == name:
+                return i
+        return -1
+
+    def won(self) -> numpy.ndarray:
+        """Boolean mask of winning games."""
+        return self.columns['ktyp_id'] == self.ktyp_id('winning')
+
+    def group_keys(self, by: str) -> Tuple[numpy.ndarray, List[str]]:
+        """Return (int key per game, label per key) for a grouping.
+
+        'combo' groups by species and background together.
+        """
+        if by == 'combo':
+            sp = self.columns['species_id'].astype(numpy.int64)
+            bg = self.columns['background_id'].astype(numpy.int64)
+            width = int(bg.max()) + 1 if self.rows else 1
+            keys = sp * width + bg
+            n = (int(sp.max()) + 1) * width if self.rows else 0
+            species = self.dimensions['species']
+            backgrounds = self.dimensions['background']
+            labels = [
+                species.get(k // width, '?') + backgrounds.get(k % width, '?')
+                for k in range(n)
+            ]
+            return keys, labels
+        if by not in GROUPINGS:
+            raise ValueError("Can't group by %s" % by)
+        column, dim = GROUPINGS[by]
+        keys = self.columns[column].astype(numpy.int64)
+        n = int(keys.max()) + 1 if self.rows else 0
+        names = self.dimensions[dim]
+        return keys, [names.get(i, '?') for i in range(n)]
+
+
+def _mask(snap: Snapshot,
+          winning: Optional[bool],
+          mask: Optional[numpy.ndarray]) -> Optional[numpy.ndarray]:
+    """Combine a winning filter with an optional extra mask."""
+    if winning is not None:
+        won = snap.won()
+        won = won if winning else ~won
+        mask = won if mask is None else mask & won
+    return mask
+
+
+def win_rates(snap: Snapshot, by: str,
+              min_games: int=1) -> Sequence[Tuple[str, int, int, float]]:
+    """Return games played, wins and win rate per group.
+
+    Parameters:
+        by: 'species', 'background', 'god', 'version', 'place', or 'combo'
+        min_games: skip groups with fewer games than this
+
+    Returns:
+        List of (label, games, wins, win rate), best win rate first.
+    """
+    keys, labels = snap.group_keys(by)
+    games = numpy.bincount(keys, minlength=len(labels))
+    wins = numpy.bincount(keys[snap.won()], minlength=len(labels))
+    out = []
+    for i in numpy.flatnonzero(games >= max(min_games, 1)):
+        out.append((labels[i], int(games[i]), int(wins[i]),
+                    float(wins[i]) / float(games[i])))
+    return sorted(out, key=lambda r: (-r[3], -r[1], r[0]))
+
+
+def aggregate(snap: Snapshot,
+              column: str,
+              by: str,
+              *,
+              winning: Optional[bool]=None,
+              mask: Optional[numpy.ndarray]=None) \
+        -> Sequence[Tuple[str, int, float, int, int]]:
+    """Aggregate a numeric column per group.
+
+    Parameters:
+        column: eg 'score', 'turn', 'dur'
+        by: see win_rates
+        winning: If specified, only (non-)winning games
+        mask: If specified, only games where mask is True
+
+    Returns:
+        List of (label, games, mean, min, max) for groups with games, in
+        label order.
+    """
+    keys, labels = snap.group_keys(by)
+    values = snap.columns[column]
+    mask = _mask(snap, winning, mask)
+    if mask is not None:
+        keys = keys[mask]
+        values = values[mask]
+    if not len(keys):
+        return []
+    order = numpy.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = values[order]
+    groups, starts, counts = numpy.unique(
+        keys, return_index=True, return_counts=True)
+    sums = numpy.add.reduceat(values.astype(numpy.float64), starts)
+    mins = numpy.minimum.reduceat(values, starts)
+    maxs = numpy.maximum.reduceat(values, starts)
+    out = [(labels[g], int(c), float(t) / int(c), int(lo), int(hi))
+           for g, c, t, lo, hi in zip(groups, counts, sums, mins, maxs)]
+    return sorted(out, key=lambda r: r[0])
+
+
+def percentiles(snap: Snapshot,
+                column: str,
+                pcts: Sequence[float]=(50, 90, 99),
+                *,
+                winning: Optional[bool]=None,
+                mask: Optional[numpy.ndarray]=None) -> Dict[float, float]:
+    """Return {percentile: value} for a numeric column."""
+    values = snap.columns[column]
+    mask = _mask(snap, winning, mask)
+    if mask is not None:
+        values = values[mask]
+    if not len(values):
+        return {}
+    return dict(zip(pcts, (float(v) for v in numpy.percentile(values, pcts))))
+
+
+def histogram(snap: Snapshot,
+              column: str,
+              bins: int=20,
+              *,
+              log: bool=False,
+              winning: Optional[bool]=None,
+              mask: Optional[numpy.ndarray]=None) \
+        -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Return (counts, bin edges) for a numeric column.
+
+    If log is True, bins are spaced logarithmically (useful for scores).
+    """
+    values = snap.columns[column]
+    mask = _mask(snap, winning, mask)
+    if mask is not None:
+        values = values[mask]
+    if log:
+        values = values[values > 0]
+        if not len(values):
+            return numpy.zeros(bins, dtype=numpy.int64), numpy.zeros(bins + 1)
+        edges = numpy.logspace(0, numpy.log10(values.max()) + 1e-9, bins + 1)
+        return numpy.histogram(values, bins=edges)
+    return numpy.histogram(values, bins=bins)
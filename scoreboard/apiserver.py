@@ -0,0 +1,534 @@
+"""Serve a JSON query API over the database (loader.py --serve-api).
+
+Anything the website doesn't pre-generate can be queried here:
+
+    GET /players/<name>                 player summary
+    GET /players/<name>/games           game history, newest first
+        ?limit=N&won=1&after=<next>     (pass the previous page's next)
+    GET /highscores?version=0.20        overall highscores
+    GET /highscores/<board>             species, backgrounds, gods or combos
+    GET /wins/fastest, /wins/shortest   fastest/shortest wins
+    GET /streaks?active=1               streaks, longest first
+    GET /metrics                        request counts and timings
+
+Games have the same fields as the api/2 player history (see
+scoreboard.playerapi.game_dict). Most endpoints also accept limit and
+max_age (days).
+
+Requests are parsed by an asyncio server, and queries run in a pool of
+threads, each with its own read-only session. Responses are cached per URL
+until the database generation changes (see model.bump_generation), which is
+checked at most every GENERATION_CHECK_INTERVAL seconds.
+"""
+
+import re
+import json
+import time
+import asyncio
+import hashlib
+import datetime
+import threading
+import collections
+import urllib.parse
+import concurrent.futures
+from typing import Callable, Dict, List, Match, Optional, Pattern, Tuple
+
+import sqlalchemy.orm  # for sqlalchemy.orm.session.Session type hints
+
+from . import model
+from . import orm
+from . import playerapi
+from . import constants as const
+
+PORT = 8001
+WORKERS = 4
+CACHE_SIZE = 1000
+GENERATION_CHECK_INTERVAL = 5
+# Browsers and proxies may reuse responses for this long
+MAX_AGE = 60
+DEFAULT_LIMIT = const.GLOBAL_TABLE_LENGTH
+MAX_LIMIT = 1000
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_TIMEOUT = 30
+MAX_HEADERS = 100
+# Request duration histogram bucket upper bounds, in ms
+LATENCY_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+STATUS_REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+
+class APIError(Exception):
+    """An error response for the client, eg a bad parameter."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+Params = Dict[str, str]
+Endpoint = Callable[[sqlalchemy.orm.session.Session, Match, Params], object]
+
+
+def _int_param(params: Params,
+               name: str,
+               default: Optional[int],
+               maximum: Optional[int]=None) -> Optional[int]:
+    if name not in params:
+        return default
+    try:
+        value = int(params[name])
+    except ValueError:
+        raise APIError(400, "%s must be an integer" % name)
+    if value < 1 or (maximum is not None and value > maximum):
+        raise APIError(400, "%s must be between 1 and %s" %
+                       (name, maximum or 'infinity'))
+    return value
+
+
+def _bool_param(params: Params, name: str) -> Optional[bool]:
+    if name not in params:
+        return None
+    if params[name] not in ('0', '1'):
+        raise APIError(400, "%s must be 0 or 1" % name)
+    return params[name] == '1'
+
+
+def _limit(params: Params) -> int:
+    return _int_param(params, 'limit', DEFAULT_LIMIT, MAX_LIMIT)
+
+
+def _max_age(params: Params) -> Optional[int]:
+    return _int_param(params, 'max_age', None)
+
+
+# Lookup tables for playerapi.game_dict, and the generation they're from.
+# Shared by the query threads.
+_lookups_lock = threading.Lock()
+_lookups = {}  # type: Dict[int, Dict[str, dict]]
+
+
+def _get_lookups(s: sqlalchemy.orm.session.Session,
+                 generation: int) -> Dict[str, dict]:
+    with _lookups_lock:
+        if generation not in _lookups:
+            _lookups.clear()
+            _lookups[generation] = playerapi.get_lookups(s)
+        return _lookups[generation]
+
+
+def _game(game: orm.Game, lookups: Dict[str, dict]) -> dict:
+    row = [getattr(game, col.key) for _, col in playerapi.COLUMNS]
+    return playerapi.game_dict(row, game.player.name, lookups)
+
+
+def _streak(streak: orm.Streak) -> dict:
+    games = streak.games
+    return {
+        'player': streak.player.name,
+        'active': streak.active,
+        'wins': len(games),
+        'games': [g.gid for g in games],
+        'start': playerapi.epoch(games[0].start) if games else None,
+        'end': playerapi.epoch(games[-1].end) if games else None,
+    }
+
+
+def _player(s: sqlalchemy.orm.session.Session, name: str) -> orm.Player:
+    player = model.find_player(s, name)
+    if player is None:
+        raise APIError(404, "Unknown player %s" % name)
+    return player
+
+
+class Queries:
+    """The API endpoints, which run in the query threads.
+
+    Each takes (session, URL path match, query parameters) and returns a
+    JSON-compatible object.
+    """
+
+    def __init__(self) -> None:
+        self.generation = 0
+
+    def player(self, s: sqlalchemy.orm.session.Session, match: Match,
+               params: Params) -> object:
+        player = _player(s, match.group('name'))
+        lookups = _get_lookups(s, self.generation)
+        data = model.player_page_data(s, [player.id]).get(player.id)
+        if data is None:
+            return {'name': player.name, 'games': 0}
+        streak = data['active_streak']
+        return {
+            'name': player.name,
+            'games': data['n_games'],
+            'boring_games': data['n_boring_games'],
+            'wins': len(data['won_games']),
+            'total_dur': data['total_dur'],
+            'highscore': _game(data['highscore'], lookups),
+            'recent_games': [_game(g, lookups) for g in data['recent_games']],
+            'active_streak': len(streak.games) if streak else 0,
+        }
+
+    def player_games(self, s: sqlalchemy.orm.session.Session, match: Match,
+                     params: Params) -> object:
+        player = _player(s, match.group('name'))
+        limit = _int_param(params, 'limit', playerapi.PAGE_SIZE, MAX_LIMIT)
+        after = None
+        if 'after' in params:
+            end, _, gid = params['after'].partition(',')
+            try:
+                after = (datetime.datetime.utcfromtimestamp(int(end)), gid)
+            except ValueError:
+                raise APIError(400, "Bad after, use a previous response's "
+                               "next value")
+        lookups = _get_lookups(s, self.generation)
+        batch = next(
+            model.iter_game_batches(
+                s,
+                player=player,
+                winning=_bool_param(params, 'won'),
+                batch_size=limit,
+                after=after,
+                columns=[col for _, col in playerapi.COLUMNS]), [])
+        next_page = None
+        if len(batch) == limit:
+            last = batch[-1]
+            next_page = '%s,%s' % (playerapi.epoch(last.end), last.gid)
+        return {
+            'player': player.name,
+            'games':
+            [playerapi.game_dict(row, player.name, lookups) for row in batch],
+            'next': next_page,
+        }
+
+    def highscores(self, s: sqlalchemy.orm.session.Session, match: Match,
+                   params: Params) -> object:
+        lookups = _get_lookups(s, self.generation)
+        games = model.highscores(
+            s,
+            limit=_limit(params),
+            max_age=_max_age(params),
+            version=params.get('version'))
+        return [_game(g, lookups) for g in games]
+
+    def board_highscores(self, s: sqlalchemy.orm.session.Session,
+                         match: Match, params: Params) -> object:
+        boards = {
+            'species': model.species_highscores,
+            'backgrounds': model.background_highscores,
+            'gods': model.god_highscores,
+            'combos': model.combo_highscores,
+        }
+        lookups = _get_lookups(s, self.generation)
+        games = boards[match.group('board')](s)
+        return [_game(g, lookups) for g in games]
+
+    def wins(self, s: sqlalchemy.orm.session.Session, match: Match,
+             params: Params) -> object:
+        lookups = _get_lookups(s, self.generation)
+        if match.group('kind') == 'fastest':
+            games = model.fastest_wins(
+                s, limit=_limit(params), max_age=_max_age(params))
+        else:
+            games = model.shortest_wins(
+                s, limit=_limit(params), max_age=_max_age(params))
+        return [_game(g, lookups) for g in games]
+
+    def streaks(self, s: sqlalchemy.orm.session.Session, match: Match,
+                params: Params) -> object:
+        streaks = model.get_streaks(
+            s,
+            active=_bool_param(params, 'active'),
+            limit=_limit(params),
+            max_age=_max_age(params))
+        return [_streak(streak) for streak in streaks]
+
+    def routes(self) -> List[Tuple[str, Pattern, Endpoint]]:
+        """Return (endpoint name, path pattern, endpoint) tuples."""
+        name = r'(?P<name>[^/]+)'
+        return [
+            ('player', re.compile(r'/players/%s$' % name), self.player),
+            ('player_games', re.compile(r'/players/%s/games$' % name),
+             self.player_games),
+            ('highscores', re.compile(r'/highscores$'), self.highscores),
+            ('board_highscores', re.compile(
+                r'/highscores/(?P<board>species|backgrounds|gods|combos)$'),
+             self.board_highscores),
+            ('wins', re.compile(r'/wins/(?P<kind>fastest|shortest)$'),
+             self.wins),
+            ('streaks', re.compile(r'/streaks$'), self.streaks),
+        ]
+
+
+class Metrics:
+    """Request counts and timings per endpoint."""
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.endpoints = {}  # type: Dict[str, dict]
+
+    def record(self, endpoint: str, status: int, cached: bool,
+               secs: float) -> None:
+        """Record a finished request."""
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {
+                'requests': 0,
+                'errors': 0,
+                'cache_hits': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                # Counts per LATENCY_BUCKETS bucket, then slower requests
+                'latency_counts': [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+        stats = self.endpoints[endpoint]
+        ms = secs * 1000
+        stats['requests'] += 1
+        stats['errors'] += status >= 500
+        stats['cache_hits'] += cached
+        stats['total_ms'] += ms
+        stats['max_ms'] = max(stats['max_ms'], ms)
+        bucket = next((i for i, b in enumerate(LATENCY_BUCKETS) if ms <= b),
+                      len(LATENCY_BUCKETS))
+        stats['latency_counts'][bucket] += 1
+
+    def as_dict(self) -> dict:
+        """Return the metrics as a JSON-compatible dict."""
+        endpoints = {}
+        for endpoint, stats in self.endpoints.items():
+            stats = dict(stats, latency_counts=list(stats['latency_counts']))
+            stats['mean_ms'] = round(stats['total_ms'] / stats['requests'], 2)
+            stats['total_ms'] = round(stats['total_ms'], 1)
+            stats['max_ms'] = round(stats['max_ms'], 1)
+            endpoints[endpoint] = stats
+        return {
+            'uptime_secs': round(time.time() - self.started),
+            'latency_buckets_ms': list(LATENCY_BUCKETS),
+            'endpoints': endpoints,
+        }
+
+
+class Response:
+    """An encoded JSON response."""
+
+    def __init__(self, status: int, obj: object) -> None:
+        self.status = status
+        self.body = json.dumps(
+            obj, sort_keys=True, separators=(',', ':')).encode('utf8')
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()[:20]
+
+
+class APIServer:
+    """The API server. Call run() to serve until interrupted.
+
+    Parameters:
+        workers: number of query threads. Each holds a read-only session,
+            so with postgres use a connection pool at least this big.
+        cache_size: number of responses to cache
+    """
+
+    def __init__(self, workers: int=WORKERS,
+                 cache_size: int=CACHE_SIZE) -> None:
+        self.queries = Queries()
+        self.routes = self.queries.routes()
+        self.metrics = Metrics()
+        self.cache_size = cache_size
+        # {(generation, path, query): Response}, least recently used first
+        self._cache = collections.OrderedDict(
+        )  # type: collections.OrderedDict
+        # Queries in progress, so concurrent identical requests share one
+        self._pending = {}  # type: Dict[tuple, asyncio.Future]
+        self._generation_checked = 0.0
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def _session(self) -> sqlalchemy.orm.session.Session:
+        """Return this query thread's read-only session."""
+        if not hasattr(self._local, 'session'):
+            self._local.session = orm.get_session(readonly=True)
+        return self._local.session
+
+    def _query(self, endpoint: Endpoint, match: Match,
+               params: Params) -> Response:
+        """Run an endpoint in a query thread."""
+        s = self._session()
+        try:
+            return Response(200, endpoint(s, match, params))
+        except APIError as e:
+            return Response(e.status, {'error': e.message})
+        finally:
+            # End the transaction, so the next query sees new data
+            s.rollback()
+
+    def _read_generation(self) -> int:
+        s = self._session()
+        try:
+            return model.get_generation(s)
+        finally:
+            s.rollback()
+
+    async def _check_generation(self) -> None:
+        """Refresh the database generation, if it's due a check."""
+        if time.time() - self._generation_checked < GENERATION_CHECK_INTERVAL:
+            return
+        self._generation_checked = time.time()
+        loop = asyncio.get_event_loop()
+        generation = await loop.run_in_executor(self._executor,
+                                                self._read_generation)
+        if generation != self.queries.generation:
+            self.queries.generation = generation
+            self._cache.clear()
+
+    async def respond(self, path: str, query: str) -> Tuple[str, Response,
+                                                             bool]:
+        """Return (endpoint name, response, whether it was cached)."""
+        if path == '/metrics':
+            metrics = self.metrics.as_dict()
+            metrics['generation'] = self.queries.generation
+            metrics['cached_responses'] = len(self._cache)
+            return 'metrics', Response(200, metrics), False
+        for name, pattern, endpoint in self.routes:
+            match = pattern.match(path)
+            if match:
+                break
+        else:
+            return 'unknown', Response(404, {'error': 'Unknown endpoint'}), \
+                False
+
+        await self._check_generation()
+        key = (self.queries.generation, path, query)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return name, self._cache[key], True
+        if key in self._pending:
+            return name, await asyncio.shield(self._pending[key]), True
+
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(query).items()}
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self._executor, self._query, endpoint,
+                                      match, params)
+        self._pending[key] = future
+        try:
+            response = await future
+        finally:
+            del self._pending[key]
+        if response.status < 500 and key[0] == self.queries.generation:
+            self._cache[key] = response
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return name, response, False
+
+    async def _send(self, writer: asyncio.StreamWriter,
+                    response: Response,
+                    headers: Dict[str, str],
+                    head: bool,
+                    keep_alive: bool) -> None:
+        status = response.status
+        body = response.body
+        if status == 200 and response.etag in headers.get(
+                'if-none-match', ''):
+            status, body = 304, b''
+        lines = [
+            'HTTP/1.1 %s %s' % (status, STATUS_REASONS.get(status, '')),
+            'Content-Type: application/json',
+            'Content-Length: %s' % len(body),
+            'Access-Control-Allow-Origin: *',
+            'Connection: %s' % ('keep-alive' if keep_alive else 'close'),
+        ]
+        if response.status == 200:
+            lines.append('ETag: %s' % response.etag)
+            lines.append('Cache-Control: public, max-age=%s' % MAX_AGE)
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not head:
+            writer.write(body)
+        await writer.drain()
+
+    async def _read_request(self, reader: asyncio.StreamReader) \
+            -> Optional[Tuple[str, str, str, Dict[str, str]]]:
+        """Return (method, target, version, headers), or None at EOF."""
+        line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+        if not line:
+            return None
+        method, target, version = line.decode('latin-1').split()
+        headers = {}  # type: Dict[str, str]
+        for _ in range(MAX_HEADERS):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError("Too many headers")
+        return method, target, version, headers
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        """Serve the requests of one connection."""
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.TimeoutError, ValueError):
+                    return
+                if request is None:
+                    return
+                method, target, version, headers = request
+                keep_alive = (version == 'HTTP/1.1' and
+                              headers.get('connection', '').lower() != 'close')
+                start = time.time()
+                parts = urllib.parse.urlsplit(target)
+                path = urllib.parse.unquote(parts.path).rstrip('/') or '/'
+                cached = False
+                if method not in ('GET', 'HEAD'):
+                    name = 'unknown'
+                    response = Response(405, {'error': 'Use GET'})
+                else:
+                    try:
+                        name, response, cached = await self.respond(
+                            path, parts.query)
+                    except Exception as e:  # pylint: disable=broad-except
+                        print("Error serving %s: %r" % (target, e))
+                        name = 'error'
+                        response = Response(500, {'error': 'Server error'})
+                await self._send(writer, response, headers, method == 'HEAD',
+                                 keep_alive)
+                self.metrics.record(name, response.status, cached,
+                                    time.time() - start)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def run(self, bind: str='', port: int=PORT) -> None:
+        """Serve at http://bind:port/ until interrupted."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(
+            asyncio.start_server(self.handle, bind or None, port))
+        print("Serving API at port %s" % port)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self._executor.shutdown()
+            loop.close()
+
+
+def serve_api(bind: str='',
+              port: int=PORT,
+              workers: int=WORKERS,
+              cache_size: int=CACHE_SIZE) -> None:
+    """Run the API server until interrupted. See APIServer."""
+    APIServer(workers=workers, cache_size=cache_size).run(bind, port)
@@ -0,0 +1,166 @@
+"""Build the website's static assets with fingerprinted filenames.
+
+CSS and JS files are bundled and minified, and every asset is written to
+a filename containing a hash of its content (eg css/site.3f2a9c1b2d.css),
+so the web server can let browsers cache them forever. Templates link to
+assets with the asset_url() Jinja global.
+
+static/assets.json records a hash of the sources and the fingerprinted
+name of each asset. When the sources haven't changed the build is skipped.
+"""
+
+import os
+import re
+import json
+import hashlib
+from typing import Dict, List, Match, Sequence, Tuple
+
+import jsmin
+import jinja2
+
+from . import sitewriter
+
+SOURCE_DIR = os.path.join(os.path.dirname(__file__), 'html_static')
+MANIFEST = 'static/assets.json'
+# Bump to rebuild assets after changing how they're built
+PIPELINE_VERSION = 1
+
+# (asset name, sources). Sources are paths in SOURCE_DIR, or
+# 'template:<name>' for a rendered template.
+BUNDLES = (
+    ('css/site.css', ('css/awesomplete.css', 'css/style.css')),
+    # tether has to load before bootstrap, which comes from a CDN
+    ('js/tether.js', ('js/tether.min.js', )),
+    ('js/site.js', ('js/awesomplete.min.js', 'js/jquery.timeago.js',
+                    'template:dcss-scoreboard.js')), )
+IMAGES = ('images/background.png', 'images/logo.png')
+
+CSS_URL_PATTERN = re.compile(r'url\("?\.\./([^")]+)"?\)')
+
+
+def fingerprint(name: str, data: bytes) -> str:
+    """Return name with a hash of data before its extension."""
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, hashlib.sha1(data).hexdigest()[:10], ext)
+
+
+def minify_css(css: str) -> str:
+    """Strip comments and unnecessary whitespace from CSS."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+def _read_sources(env: jinja2.environment.Environment) \
+        -> Tuple[str, Dict[str, bytes]]:
+    """Return (hash of all sources, {source: content})."""
+    sources = {}  # type: Dict[str, bytes]
+    for source in [s for _, group in BUNDLES for s in group] + list(IMAGES):
+        if source.startswith('template:'):
+            template = env.get_template(source[len('template:'):])
+            sources[source] = template.render().encode('utf8')
+        else:
+            with open(os.path.join(SOURCE_DIR, source), 'rb') as f:
+                sources[source] = f.read()
+    h = hashlib.sha1(str(PIPELINE_VERSION).encode())
+    for source in sorted(sources):
+        h.update(source.encode('utf8'))
+        h.update(hashlib.sha1(sources[source]).digest())
+    return h.hexdigest(), sources
+
+
+def _bundle_js(sources: Sequence[str], content: Dict[str, bytes]) -> str:
+    parts = []  # type: List[str]
+    for source in sources:
+        js = content[source].decode('utf8')
+        if not source.endswith('.min.js'):
+            js = jsmin.jsmin(js)
+        parts.append(js)
+    return ';\n'.join(parts)
+
+
+def _bundle_css(sources: Sequence[str], content: Dict[str, bytes],
+                assets: Dict[str, str]) -> str:
+    css = minify_css('\n'.join(content[s].decode('utf8') for s in sources))
+
+    def fingerprinted_url(match: Match) -> str:
+        return 'url("../%s")' % assets.get(match.group(1), match.group(1))
+
+    return CSS_URL_PATTERN.sub(fingerprinted_url, css)
+
+
+def _load_manifest(root: str) -> dict:
+    try:
+        with open(os.path.join(root, MANIFEST), encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _is_built(writer: sitewriter.SiteWriter, name: str, path: str) -> bool:
+    """Check an asset (and its compressed copies, if needed) exists."""
+    full_path = os.path.join(writer.root, 'static', path)
+    paths = [full_path]
+    if writer.compress and name not in IMAGES:
+        paths += sitewriter.compressed_paths(full_path)
+    return all(os.path.exists(p) for p in paths)
+
+
+def build_assets(env: jinja2.environment.Environment,
+                 writer: sitewriter.SiteWriter) -> Dict[str, str]:
+    """Build the static assets into writer's static directory.
+
+    Old fingerprinted files are left in place, so cached pages which link
+    to them keep working.
+
+    Returns:
+        Dict of form {asset name: fingerprinted path relative to static/}.
+    """
+    source_hash, content = _read_sources(env)
+    manifest = _load_manifest(writer.root)
+    assets = manifest.get('assets', {})  # type: Dict[str, str]
+    if manifest.get('source_hash') == source_hash and all(
+            _is_built(writer, name, path) for name, path in assets.items()):
+        print("Static assets are up to date")
+        return assets
+
+    print("Building static assets")
+    assets = {}
+    for image in IMAGES:
+        assets[image] = fingerprint(image, content[image])
+        writer.write_bytes('static/' + assets[image], content[image])
+    for name, sources in BUNDLES:
+        if name.endswith('.css'):
+            data = _bundle_css(sources, content, assets)
+        else:
+            data = _bundle_js(sources, content)
+        assets[name] = fingerprint(name, data.encode('utf8'))
+        writer.write('static/' + assets[name], data)
+    writer.write(MANIFEST,
+                 json.dumps(
+                     {
+                         'source_hash': source_hash,
+                         'assets': assets
+                     },
+                     sort_keys=True,
+                     indent=2))
+    return assets
+
+
+def load_assets(root: str) -> Dict[str, str]:
+    """Return the assets built by build_assets in the website dir root."""
+    return _load_manifest(root).get('assets', {})
+
+
+def install(env: jinja2.environment.Environment,
+            assets: Dict[str, str]) -> None:
+    """Add the asset_url() global to a Jinja environment."""
+    urlbase = env.globals['urlbase']
+
+    def asset_url(name: str) -> str:
+        """Return the URL of a static asset, eg asset_url('js/site.js')."""
+        return '%s/static/%s' % (urlbase, assets[name])
+
+    env.globals['asset_url'] = asset_url
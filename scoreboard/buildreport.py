@@ -0,0 +1,158 @@
+"""Time the stages and pages of a website build.
+
+Each page type's time is split into database queries, template rendering
+and writing files, and the slowest player pages are tracked along with
+their game counts. The report is saved as JSON at the end of the build,
+and can also be appended to a history file (one JSON report per line) to
+track build times over time.
+"""
+
+import os
+import json
+import time
+import heapq
+import datetime
+import tempfile
+import contextlib
+import collections
+from typing import Dict, Iterator, List, Optional, Tuple
+
+PHASES = ('query', 'render', 'write')
+
+
+class BuildReport:
+    """Collect the timings of a website build.
+
+    Usage:
+        report = BuildReport()
+        with report.stage('index'):
+            with report.timed('index', 'query'):
+                ...
+            report.page('index')
+        report.player_page('alice', games=12, query=.01, render=.02,
+                           write=.001)
+        report.save('build-report.json')
+
+    Parameters:
+        top: number of slowest player pages to keep
+    """
+
+    def __init__(self, top: int=10) -> None:
+        self.top = top
+        self.started = time.time()
+        self.finished = None  # type: Optional[float]
+        self.stages = collections.OrderedDict()  # type: Dict[str, float]
+        self.pages = collections.OrderedDict()  # type: Dict[str, dict]
+        # Min-heap of (total secs, player, games, query, render, write)
+        self._slowest = [
+        ]  # type: List[Tuple[float, str, int, float, float, float]]
+
+    def _page_type(self, page_type: str) -> dict:
+        if page_type not in self.pages:
+            self.pages[page_type] = {'pages': 0}
+            for phase in PHASES:
+                self.pages[page_type][phase] = 0.0
+        return self.pages[page_type]
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage of the build."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name,
+                                                0.0) + time.time() - start
+
+    @contextlib.contextmanager
+    def timed(self, page_type: str, phase: str) -> Iterator[None]:
+        """Add the time spent in the block to a page type's phase."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(page_type, phase, time.time() - start)
+
+    def add(self, page_type: str, phase: str, secs: float) -> None:
+        """Add secs to a page type's phase, one of PHASES."""
+        self._page_type(page_type)[phase] += secs
+
+    def page(self, page_type: str, n: int=1) -> None:
+        """Count pages written of a page type."""
+        self._page_type(page_type)['pages'] += n
+
+    def player_page(self, name: str, *, games: int, query: float,
+                    render: float, write: float) -> None:
+        """Record the timings of a player page."""
+        self.add('player', 'query', query)
+        self.add('player', 'render', render)
+        self.add('player', 'write', write)
+        self.page('player')
+        entry = (query + render + write, name, games, query, render, write)
+        if len(self._slowest) < self.top:
+            heapq.heappush(self._slowest, entry)
+        elif entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def finish(self) -> None:
+        """Mark the build as finished."""
+        self.finished = time.time()
+
+    def as_dict(self) -> dict:
+        """Return the report as a JSON-compatible dict, times in ms."""
+
+        def ms(secs: float) -> float:
+            return round(secs * 1000, 1)
+
+        finished = self.finished or time.time()
+        return {
+            'started':
+            datetime.datetime.utcfromtimestamp(self.started).isoformat(),
+            'duration_ms': ms(finished - self.started),
+            'stages_ms': {name: ms(secs)
+                          for name, secs in self.stages.items()},
+            'pages': {
+                page_type: dict(
+                    [('pages', stats['pages'])] +
+                    [(phase + '_ms', ms(stats[phase])) for phase in PHASES])
+                for page_type, stats in self.pages.items()
+            },
+            'slowest_player_pages': [{
+                'player': name,
+                'games': games,
+                'total_ms': ms(total),
+                'query_ms': ms(query),
+                'render_ms': ms(render),
+                'write_ms': ms(write),
+            } for total, name, games, query, render, write in sorted(
+                self._slowest, reverse=True)],
+        }
+
+    def summary(self) -> str:
+        """Return a short plain text summary of the page timings."""
+        lines = []
+        for page_type, stats in self.pages.items():
+            lines.append('%s: %s pages, %s' % (
+                page_type, stats['pages'], ', '.join(
+                    '%s %ss' % (phase, round(stats[phase], 2))
+                    for phase in PHASES)))
+        if self._slowest:
+            lines.append('Slowest player pages: %s' % ', '.join(
+                '%s (%s games, %sms)' % (name, games, round(total * 1000, 1))
+                for total, name, games, _, _, _ in sorted(
+                    self._slowest, reverse=True)[:5]))
+        return '\n'.join(lines)
+
+    def save(self, path: str) -> None:
+        """Atomically write the report to path as JSON."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(
+            dir=directory, prefix='.%s.' % os.path.basename(path))
+        with open(fd, 'w', encoding='utf8') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+
+    def append_to(self, path: str) -> None:
+        """Append the report to a history file, as one line of JSON."""
+        with open(path, 'a', encoding='utf8') as f:
+            f.write(json.dumps(self.as_dict(), sort_keys=True) + '\n')
@@ -278,6 +278,8 @@ KTYPS = (
     "petrification",
     "tso_smiting",
     "falling_through_gate", )
+# Games ending with these ktyps are considered boring (quit, left, wizmode)
+BORING_KTYPS = ("quitting", "leaving", "wizmode")
 KTYP_FIXUPS = {
     # Renames
     'divine wrath': 'divine_wrath',
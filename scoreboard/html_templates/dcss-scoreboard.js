@@ -1,14 +1,60 @@
-// Load the list of players and set up player autocomplete
-const ajax = new XMLHttpRequest();
-ajax.open("GET", "{{ urlbase }}/static/js/players.json", true);
-ajax.onload = function() {
-  var list = JSON.parse(ajax.responseText);
-  new Awesomplete(
-      document.querySelector("#playersearch"),
-      { list: list, filter: Awesomplete.FILTER_STARTSWITH }
-  );
-};
-ajax.send();
+// Player autocomplete. Names are fetched from a sharded index keyed by
+// prefix (see scoreboard/playerindex.py), only for what's been typed.
+const player_shards = {};
+
+function shard_key(prefix) {
+  return prefix.toLowerCase().replace(/[^a-z0-9]/g, "_");
+}
+
+function load_shard(key, callback) {
+  if (key in player_shards) {
+    callback(player_shards[key]);
+    return;
+  }
+  const ajax = new XMLHttpRequest();
+  ajax.open("GET", "{{ urlbase }}/static/players/" + key + ".json", true);
+  ajax.onload = function() {
+    player_shards[key] = ajax.status == 200 ? JSON.parse(ajax.responseText) : [];
+    callback(player_shards[key]);
+  };
+  ajax.send();
+}
+
+// Call callback with the names which might start with typed
+function load_names(typed, callback, length) {
+  length = length || 1;
+  load_shard(shard_key(typed.substr(0, length)), function(shard) {
+    if (Array.isArray(shard)) {
+      callback(shard);
+    } else if (typed.length > length) {
+      load_names(typed, function(names) {
+        callback(shard.names.concat(names));
+      }, length + 1);
+    } else {
+      // Typed is the whole prefix, so just the names shown first
+      callback(shard.preview);
+    }
+  });
+}
+
+const player_search = document.querySelector("#playersearch");
+const autocomplete = new Awesomplete(
+    player_search,
+    { list: [], minChars: 1, filter: Awesomplete.FILTER_STARTSWITH }
+);
+player_search.addEventListener("input", function() {
+  const typed = player_search.value;
+  if (!typed) {
+    return;
+  }
+  load_names(typed, function(names) {
+    // Ignore responses for text which has since changed
+    if (player_search.value == typed) {
+      autocomplete.list = names;
+      autocomplete.evaluate();
+    }
+  });
+});
 
 $('document').ready(function () {
   // Handle selecting a usernames
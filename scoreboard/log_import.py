@@ -63,18 +63,22 @@ def load_logfiles(api_url: str) -> None:
         if not len(response['results']):
             break
 
+        added = False
         for game in response['results']:
             try:
-                add_game(s, game)
+                new = add_game(s, game)
             except Exception as e:
                 print("Couldn't add game, skipping: %s" % game)
             else:
                 games += 1
+                added = added or bool(new)
             if games % 10000 == 0:
                 print("Processed %s games..." % games)
 
         current_key = response['next_offset']
         model.save_logfile_progress(s, url, current_key)
+        if added:
+            model.bump_generation(s)
         s.commit()
     s.commit()
     end = time.time()
@@ -134,12 +138,14 @@ def add_game(s: sqlalchemy.orm.session.Session, api_game: dict) -> bool:
     # Create a dict with the mappings needed for orm.Game objects
     branch = model.get_branch(s, game['br'])
     server = model.get_server(s, api_game['src_abbr'])
+    species = model.get_species(s, game['char'][:2])
+    background = model.get_background(s, game['char'][2:])
     gamedict = {
         'gid': game['gid'],
         'account_id': model.get_account_id(s, game['name'], server),
         'player_id': model.get_player_id(s, game['name']),
-        'species_id': model.get_species(s, game['char'][:2]).id,
-        'background_id': model.get_background(s, game['char'][2:]).id,
+        'species_id': species.id,
+        'background_id': background.id,
         'god_id': model.get_god(s, game['god']).id,
         'version_id': model.get_version(s, game['v']).id,
         'place_id': model.get_place(s, branch, game['lvl']).id,
@@ -152,6 +158,9 @@ def add_game(s: sqlalchemy.orm.session.Session, api_game: dict) -> bool:
         'start': modelutils.crawl_date_to_datetime(game['start']),
         'end': modelutils.crawl_date_to_datetime(game['end']),
         'ktyp_id': model.get_ktyp(s, game['ktyp']).id,
+        'won': game['ktyp'] == 'winning',
+        'boring': game['ktyp'] in const.BORING_KTYPS,
+        'char': species.short + background.short,
         'potions_used': game.get('potionsused', -1),
         'scrolls_used': game.get('scrollsused', -1),
         'dam': game.get('dam', 0),
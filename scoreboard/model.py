@@ -1,8 +1,11 @@
 """Defines the database models for this module."""
 
+import json
+import hashlib
 import functools
 import datetime
-from typing import Optional, Tuple, Callable, Sequence
+from typing import Any, Optional, Tuple, Callable, Sequence, Iterator, \
+    Iterable, Dict, List
 
 import sqlalchemy
 import sqlalchemy.orm
@@ -11,7 +14,18 @@ from sqlalchemy import func
 
 import scoreboard.constants as const
 from scoreboard.orm import Server, Player, Species, Background, God, Version, \
-    Branch, Place, Game, LogfileProgress, Achievement, Account, Ktyp, Streak
+    Branch, Place, Game, LogfileProgress, Achievement, Account, Ktyp, Streak, \
+    Setting, AwardedAchievements, DirtyPage
+
+# Reasons for a page to be in the dirty_pages queue
+DIRTY_NEW_GAMES = 'new_games'
+DIRTY_REQUESTED = 'requested'
+DIRTY_RECORDS = 'records'
+# When a page is queued for several reasons, the first of these is kept
+DIRTY_REASONS = (DIRTY_NEW_GAMES, DIRTY_REQUESTED, DIRTY_RECORDS)
+PLAYER_PAGE_PREFIX = 'player:'
+# Setting incremented whenever imported or scored games are committed
+GENERATION_SETTING = 'generation'
 
 
 class DBError(BaseException):
@@ -99,6 +113,16 @@ def get_player(s: sqlalchemy.orm.session.Session, name: str) -> Player:
         return _add_player(s, name)
 
 
+def find_player(s: sqlalchemy.orm.session.Session,
+                name: str) -> Optional[Player]:
+    """Get a player's object by (case insensitive) name, or None.
+
+    Unlike get_player, this works on a read-only session.
+    """
+    return s.query(Player).filter(
+        func.lower(Player.name) == name.lower()).one_or_none()
+
+
 @functools.lru_cache(maxsize=128)
 def get_player_id(s: sqlalchemy.orm.session.Session, name: str) -> Player:
     """Get a player's id, creating them if needed.
@@ -121,77 +145,198 @@ def _add_player(s, name: str) -> Player:
     return player
 
 
+def constants_hash() -> str:
+    """Return a hash of the reference data in constants.py."""
+    data = [
+        sorted(const.SPECIES),
+        sorted(const.BACKGROUNDS),
+        sorted(const.GODS),
+        sorted(const.BRANCHES),
+        sorted(const.KTYPS),
+        sorted(const.ACHIEVEMENTS),
+    ]
+    return hashlib.sha1(json.dumps(data).encode('utf8')).hexdigest()
+
+
+def get_setting(s: sqlalchemy.orm.session.Session, key: str) -> Optional[str]:
+    """Get a setting's value, or None if it isn't set."""
+    value = s.query(Setting.value).filter(Setting.key == key).one_or_none()
+    return value[0] if value else None
+
+
+def set_setting(s: sqlalchemy.orm.session.Session, key: str,
+                value: str) -> None:
+    """Set a setting's value."""
+    s.merge(Setting(key=key, value=value))
+
+
+def get_generation(s: sqlalchemy.orm.session.Session) -> int:
+    """Return the database generation, see bump_generation."""
+    return int(get_setting(s, GENERATION_SETTING) or 0)
+
+
+def bump_generation(s: sqlalchemy.orm.session.Session) -> None:
+    """Increment the database generation.
+
+    Call this in every transaction which adds or scores games, so caches of
+    query results (see scoreboard.apiserver) know when they're stale. The
+    increment is a single UPDATE, so concurrent bumps can't be lost. The
+    setting is created by setup_constants.
+    """
+    s.query(Setting).filter(Setting.key == GENERATION_SETTING).update(
+        {
+            Setting.value: sqlalchemy.cast(
+                sqlalchemy.cast(Setting.value, sqlalchemy.Integer) + 1,
+                sqlalchemy.String)
+        },
+        synchronize_session=False)
+
+
+def setup_constants(s: sqlalchemy.orm.session.Session,
+                    settings: Dict[str, str]) -> None:
+    """Load all reference data from constants.py into the database.
+
+    Parameters:
+        settings: the current settings, see orm.read_settings. If the
+            constants_hash setting (the hash of the constants last loaded
+            into the database) matches the current constants, nothing
+            needs to be done.
+    """
+    if GENERATION_SETTING not in settings:
+        set_setting(s, GENERATION_SETTING, '0')
+        s.commit()
+    new_hash = constants_hash()
+    if settings.get('constants_hash') == new_hash:
+        return
+    setup_species(s)
+    setup_backgrounds(s)
+    setup_gods(s)
+    setup_branches(s)
+    setup_achievements(s)
+    setup_ktyps(s)
+    set_setting(s, 'constants_hash', new_hash)
+    s.commit()
+
+
 def setup_species(s: sqlalchemy.orm.session.Session) -> None:
     """Load species data into the database."""
+    existing = {short for short, in s.query(Species.short)}
     new = []
-    for sp in const.SPECIES:
-        if not s.query(Species).filter(Species.short == sp.short).first():
+    for sp in sorted(const.SPECIES):
+        if sp.short not in existing:
             print("Adding species '%s'" % sp.full)
             new.append({
                 'short': sp.short,
                 'name': sp.full,
                 'playable': sp.playable
             })
-    s.bulk_insert_mappings(Species, new)
-    s.commit()
+    if new:
+        s.bulk_insert_mappings(Species, new)
+        s.commit()
 
 
 def setup_backgrounds(s: sqlalchemy.orm.session.Session) -> None:
     """Load background data into the database."""
+    existing = {short for short, in s.query(Background.short)}
     new = []
-    for bg in const.BACKGROUNDS:
-        if not s.query(Background).filter(
-                Background.short == bg.short).first():
+    for bg in sorted(const.BACKGROUNDS):
+        if bg.short not in existing:
             print("Adding background '%s'" % bg.full)
             new.append({
                 'short': bg.short,
                 'name': bg.full,
                 'playable': bg.playable
             })
-    s.bulk_insert_mappings(Background, new)
-    s.commit()
+    if new:
+        s.bulk_insert_mappings(Background, new)
+        s.commit()
+
+
+def _get_player_ids(s: sqlalchemy.orm.session.Session,
+                    names: Iterable[str]) -> dict:
+    """Get player ids for many names, creating players as needed.
+
+    Returns {lowercase name: id}.
+    """
+    wanted = {}  # type: dict
+    for name in names:
+        # Like get_player, the first capitalisation seen is used
+        wanted.setdefault(name.lower(), name)
+    if not wanted:
+        return {}
+
+    def existing() -> dict:
+        q = s.query(Player.name, Player.id).filter(
+            func.lower(Player.name).in_(wanted))
+        return {name.lower(): i for name, i in q}
+
+    ids = existing()
+    missing = [name for lower, name in wanted.items() if lower not in ids]
+    if missing:
+        now = datetime.datetime.now()
+        s.bulk_insert_mappings(
+            Player, [{'name': name,
+                      'page_updated': now} for name in missing])
+        ids = existing()
+    return ids
 
 
 def setup_achievements(s: sqlalchemy.orm.session.Session) -> None:
     """Load manual achievements into the database."""
-    for proto in const.ACHIEVEMENTS:
-        if not s.query(Achievement).filter(
-                Achievement.name == proto.name).one_or_none():
-            print("Adding achievement '%s'" % proto.name)
-            achievement = Achievement()
-            achievement.key = proto.key
-            achievement.name = proto.name
-            achievement.description = proto.description
-            s.add(achievement)
-            for player_name in proto.players:
-                print("Awarding achievement '%s' to '%s'" %
-                      (achievement.name, player_name))
-                player = get_player(s, player_name)
-                player.achievements.append(achievement)
-                s.add(player)
+    existing = {name for name, in s.query(Achievement.name)}
+    new = [proto for proto in const.ACHIEVEMENTS if proto.name not in existing]
+    if not new:
+        return
+    for proto in new:
+        print("Adding achievement '%s'" % proto.name)
+    s.bulk_insert_mappings(Achievement, [{
+        'key': proto.key,
+        'name': proto.name,
+        'description': proto.description
+    } for proto in new])
+    achievement_ids = dict(
+        s.query(Achievement.name, Achievement.id).filter(
+            Achievement.name.in_([proto.name for proto in new])))
+    player_ids = _get_player_ids(
+        s, [name for proto in new for name in proto.players])
+    awards = []
+    for proto in new:
+        for player_name in proto.players:
+            print("Awarding achievement '%s' to '%s'" %
+                  (proto.name, player_name))
+            awards.append({
+                'player_id': player_ids[player_name.lower()],
+                'achievement_id': achievement_ids[proto.name]
+            })
+    if awards:
+        s.execute(AwardedAchievements.insert(), awards)
     s.commit()
 
 
 def setup_gods(s: sqlalchemy.orm.session.Session) -> None:
     """Load god data into the database."""
+    existing = {name for name, in s.query(God.name)}
     new = []
-    for god in const.GODS:
-        if not s.query(God).filter(God.name == god.name).first():
+    for god in sorted(const.GODS):
+        if god.name not in existing:
             print("Adding god '%s'" % god.name)
             new.append({'name': god.name, 'playable': god.playable})
-    s.bulk_insert_mappings(God, new)
-    s.commit()
+    if new:
+        s.bulk_insert_mappings(God, new)
+        s.commit()
 
 
 def setup_ktyps(s: sqlalchemy.orm.session.Session) -> None:
     """Load ktyp data into the database."""
+    existing = {name for name, in s.query(Ktyp.name)}
     new = []
     for ktyp in const.KTYPS:
-        if not s.query(Ktyp).filter(Ktyp.name == ktyp).first():
+        if ktyp not in existing:
             print("Adding ktyp '%s'" % ktyp)
             new.append({'name': ktyp})
-    s.bulk_insert_mappings(Ktyp, new)
-    s.commit()
+    if new:
+        s.bulk_insert_mappings(Ktyp, new)
+        s.commit()
 
 
 @functools.lru_cache(maxsize=32)
@@ -209,9 +354,10 @@ def get_version(s: sqlalchemy.orm.session.Session, v: str) -> Version:
 
 def setup_branches(s: sqlalchemy.orm.session.Session) -> None:
     """Load branch data into the database."""
+    existing = {short for short, in s.query(Branch.short)}
     new = []
-    for br in const.BRANCHES:
-        if not s.query(Branch).filter(Branch.short == br.short).first():
+    for br in sorted(const.BRANCHES):
+        if br.short not in existing:
             print("Adding branch '%s'" % br.full)
             new.append({
                 'short': br.short,
@@ -219,8 +365,9 @@ def setup_branches(s: sqlalchemy.orm.session.Session) -> None:
                 'multilevel': br.multilevel,
                 'playable': br.playable
             })
-    s.bulk_insert_mappings(Branch, new)
-    s.commit()
+    if new:
+        s.bulk_insert_mappings(Branch, new)
+        s.commit()
 
 
 @functools.lru_cache(maxsize=256)
@@ -314,10 +461,10 @@ def get_branch(s: sqlalchemy.orm.session.Session, br: str) -> Branch:
 
 
 def create_streak(s: sqlalchemy.orm.session.Session, player: Player) -> Streak:
-    """Create a new streak for a given player."""
+    """Create a new streak for a given player, in the caller's transaction."""
     streak = Streak(player_id=player.id, active=True)
     s.add(streak)
-    s.commit()
+    s.flush()
     return streak
 
 
@@ -422,6 +569,23 @@ def list_gods(s: sqlalchemy.orm.session.Session,
     return _generic_char_type_lister(s, cls=God, playable=playable)
 
 
+def window_start(max_age: int) -> datetime.datetime:
+    """Return the start of a time window covering the last max_age days.
+
+    The cutoff is midnight (UTC) max_age days ago, so it only changes once a
+    day. It's computed in Python and bound as a parameter, which works on
+    every backend and lets the query use the index on Game.end.
+    """
+    today = datetime.datetime.utcnow().replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    return today - datetime.timedelta(days=max_age)
+
+
+def _in_window(max_age: int) -> sqlalchemy.sql.ClauseElement:
+    """Return a filter clause matching games which ended in the window."""
+    return Game.end > window_start(max_age)
+
+
 def _games(s: sqlalchemy.orm.session.Session,
            *,
            player: Optional[Player]=None,
@@ -431,6 +595,7 @@ def _games(s: sqlalchemy.orm.session.Session,
            gid: Optional[str]=None,
            winning: Optional[bool]=None,
            boring: Optional[bool]=None,
+           max_age: Optional[int]=None,
            reverse_order: Optional[bool]=False) -> sqlalchemy.orm.query.Query:
     """Build a query to match games with certain conditions.
 
@@ -440,8 +605,10 @@ def _games(s: sqlalchemy.orm.session.Session,
         scored: If specified, only games with a matching scored
         limit: If specified, up to limit games
         gid: If specified, only game with matching gid
-        winning: If specified, only games where ktyp==/!='winning'
-        boring: If specifies, only games where ktyp not boring
+        winning: If specified, only games with a matching won
+        boring: If specified, only games with a matching boring
+        max_age: If specified, only games which ended less than this many
+            days ago
         reverse_order: Return games least->most recent
 
     Returns:
@@ -458,19 +625,13 @@ def _games(s: sqlalchemy.orm.session.Session,
     if gid is not None:
         q = q.filter(Game.gid == gid)
     if winning is not None:
-        ktyp = get_ktyp(s, 'winning')
-        if winning:
-            q = q.filter(Game.ktyp_id == ktyp.id)
-        else:
-            q = q.filter(Game.ktyp_id != ktyp.id)
+        q = q.filter(Game.won == (sqlalchemy.true()
+                                  if winning else sqlalchemy.false()))
     if boring is not None:
-        boring_ktyps = [
-            get_ktyp(s, ktyp).id for ktyp in ('quitting', 'leaving', 'wizmode')
-        ]
-        if boring:
-            q = q.filter(Game.ktyp_id.in_(boring_ktyps))
-        else:
-            q = q.filter(Game.ktyp_id.notin_(boring_ktyps))
+        q = q.filter(Game.boring == (sqlalchemy.true()
+                                     if boring else sqlalchemy.false()))
+    if max_age is not None:
+        q = q.filter(_in_window(max_age))
     if reverse_order is not None:
         q = q.order_by(Game.end.desc()
                        if not reverse_order else Game.end.asc())
@@ -488,6 +649,7 @@ def list_games(s: sqlalchemy.orm.session.Session,
                gid: Optional[str]=None,
                winning: Optional[bool]=None,
                boring: Optional[bool]=None,
+               max_age: Optional[int]=None,
                reverse_order: bool=False) -> Sequence[Game]:
     """Get a list of all games that match specified conditions.
 
@@ -505,6 +667,7 @@ def list_games(s: sqlalchemy.orm.session.Session,
         gid=gid,
         winning=winning,
         boring=boring,
+        max_age=max_age,
         reverse_order=reverse_order).all()
 
 
@@ -515,7 +678,8 @@ def count_games(s: sqlalchemy.orm.session.Session,
                 scored: Optional[bool]=None,
                 gid: Optional[str]=None,
                 winning: Optional[bool]=None,
-                boring: Optional[bool]=None) -> int:
+                boring: Optional[bool]=None,
+                max_age: Optional[int]=None) -> int:
     """Get a count of all games that match specified conditions.
 
     See _games documentation for parameters.
@@ -530,7 +694,83 @@ def count_games(s: sqlalchemy.orm.session.Session,
         scored=scored,
         gid=gid,
         winning=winning,
-        boring=boring).count()
+        boring=boring,
+        max_age=max_age).count()
+
+
+def iter_game_batches(s: sqlalchemy.orm.session.Session,
+                      *,
+                      player: Optional[Player]=None,
+                      account: Optional[Account]=None,
+                      scored: Optional[bool]=None,
+                      winning: Optional[bool]=None,
+                      boring: Optional[bool]=None,
+                      max_age: Optional[int]=None,
+                      reverse_order: bool=False,
+                      batch_size: int=1000,
+                      after: Optional[Tuple[datetime.datetime, str]]=None,
+                      columns: Optional[Sequence]=None) \
+        -> Iterator[Sequence[Game]]:
+    """Yield lists of up to batch_size games that match specified conditions.
+
+    Games are paginated with a keyset on (end, gid): each batch starts
+    after the last game of the previous one instead of using an offset, so
+    every batch is an index range scan and memory use stays flat. It's safe
+    to commit between batches, even if that changes which games match.
+
+    Parameters (see _games documentation for the rest):
+        batch_size: maximum number of games per batch
+        after: If specified, start after this (end, gid) keyset
+        columns: If specified, yield rows of these Game columns instead of
+            Game objects. Must include Game.end and Game.gid.
+    """
+    q = _games(
+        s,
+        player=player,
+        account=account,
+        scored=scored,
+        winning=winning,
+        boring=boring,
+        max_age=max_age,
+        reverse_order=None)
+    if columns is not None:
+        q = q.with_entities(*columns)
+    if reverse_order:
+        q = q.order_by(Game.end.asc(), Game.gid.asc())
+    else:
+        q = q.order_by(Game.end.desc(), Game.gid.desc())
+    last = after
+    while True:
+        batch_q = q
+        if last is not None:
+            end, gid = last
+            if reverse_order:
+                batch_q = batch_q.filter(Game.end >= end,
+                                         sqlalchemy.or_(Game.end > end,
+                                                        Game.gid > gid))
+            else:
+                batch_q = batch_q.filter(Game.end <= end,
+                                         sqlalchemy.or_(Game.end < end,
+                                                        Game.gid < gid))
+        batch = batch_q.limit(batch_size).all()
+        if not batch:
+            return
+        # Remember the keyset before yielding, the caller may commit and
+        # expire the games.
+        last = (batch[-1].end, batch[-1].gid)
+        yield batch
+        if len(batch) < batch_size:
+            return
+
+
+def iter_games(s: sqlalchemy.orm.session.Session,
+               **kwargs: Any) -> Iterator[Game]:
+    """Yield games that match specified conditions, batch_size at a time.
+
+    See iter_game_batches for parameters.
+    """
+    for batch in iter_game_batches(s, **kwargs):
+        yield from batch
 
 
 def get_game(s: sqlalchemy.orm.session.Session, **kwargs: dict) -> Game:
@@ -546,14 +786,24 @@ def get_game(s: sqlalchemy.orm.session.Session, **kwargs: dict) -> Game:
 def highscores(s: sqlalchemy.orm.session.Session,
                *,
                limit: int=const.GLOBAL_TABLE_LENGTH,
-               player: Optional[Player]=None) -> Sequence[Game]:
+               player: Optional[Player]=None,
+               max_age: Optional[int]=None,
+               version: Optional[str]=None) -> Sequence[Game]:
     """Return up to limit high scores.
 
     Fewer games may be returned if there is not enough matching data.
+
+    max_age: If specified, only games which ended less than this many days
+        ago.
+    version: If specified, only games of this version, eg '0.20'.
     """
     q = s.query(Game).order_by(Game.score.desc())
     if player is not None:
         q = q.filter(Game.player_id == player.id)
+    if version is not None:
+        q = q.join(Game.version).filter(Version.v == version)
+    if max_age is not None:
+        q = q.filter(_in_window(max_age))
     return q.limit(limit).all()
 
 
@@ -637,38 +887,75 @@ def combo_highscores(s: sqlalchemy.orm.session.Session) -> Sequence[Game]:
     return results
 
 
+def _fastest_wins(s: sqlalchemy.orm.session.Session,
+                  *,
+                  limit: int=const.GLOBAL_TABLE_LENGTH,
+                  exclude_bots: bool=True,
+                  player: Optional[Player]=None,
+                  max_age: Optional[int]=None) -> sqlalchemy.orm.query.Query:
+    """Build a query for fastest_wins. See fastest_wins for parameters."""
+    q = s.query(Game).filter(Game.won == sqlalchemy.true()).order_by(Game.dur)
+    if exclude_bots:
+        # Use a subquery rather than get_player_id so this works on a
+        # read-only session.
+        bot_ids = s.query(Player.id).filter(
+            func.lower(Player.name).in_(const.BLACKLISTS['bots']))
+        q = q.filter(Game.player_id.notin_(bot_ids.subquery()))
+        for bad_gid in const.BLACKLISTS['bot-games']:
+            q = q.filter(Game.gid != bad_gid)
+    if player is not None:
+        q = q.filter(Game.player_id == player.id)
+    if max_age is not None:
+        q = q.filter(_in_window(max_age))
+    return q.limit(limit)
+
+
 def fastest_wins(s: sqlalchemy.orm.session.Session,
                  *,
                  limit: int=const.GLOBAL_TABLE_LENGTH,
                  exclude_bots: bool=True,
-                 player: Optional[Player]=None) -> Sequence[Game]:
+                 player: Optional[Player]=None,
+                 max_age: Optional[int]=None) -> Sequence[Game]:
     """Return up to limit fastest wins.
 
     exclude_bots: If True, exclude known bot accounts from the rankings.
+    max_age: If specified, only wins less than this many days old.
     """
-    ktyp = get_ktyp(s, 'winning')
-    q = s.query(Game).filter(Game.ktyp == ktyp).order_by('dur')
-    if exclude_bots:
-        for bot_name in const.BLACKLISTS['bots']:
-            bot_id = get_player_id(s, bot_name)
-            q = q.filter(Game.player_id != bot_id)
-        for bad_gid in const.BLACKLISTS['bot-games']:
-            q = q.filter(Game.gid != bad_gid)
+    return _fastest_wins(
+        s,
+        limit=limit,
+        exclude_bots=exclude_bots,
+        player=player,
+        max_age=max_age).all()
+
+
+def _shortest_wins(
+        s: sqlalchemy.orm.session.Session,
+        *,
+        limit: int=const.GLOBAL_TABLE_LENGTH,
+        player: Optional[Player]=None,
+        max_age: Optional[int]=None) -> sqlalchemy.orm.query.Query:
+    """Build a query for shortest_wins. See shortest_wins for parameters."""
+    q = s.query(Game).filter(
+        Game.won == sqlalchemy.true()).order_by(Game.turn)
     if player is not None:
         q = q.filter(Game.player_id == player.id)
-    return q.limit(limit).all()
+    if max_age is not None:
+        q = q.filter(_in_window(max_age))
+    return q.limit(limit)
 
 
 def shortest_wins(s: sqlalchemy.orm.session.Session,
                   *,
                   limit: int=const.GLOBAL_TABLE_LENGTH,
-                  player: Optional[Player]=None) -> Sequence[Game]:
-    """Return up to limit shortest wins."""
-    ktyp = get_ktyp(s, 'winning')
-    q = s.query(Game).filter(Game.ktyp == ktyp).order_by('turn')
-    if player is not None:
-        q = q.filter(Game.player_id == player.id)
-    return q.limit(limit).all()
+                  player: Optional[Player]=None,
+                  max_age: Optional[int]=None) -> Sequence[Game]:
+    """Return up to limit shortest wins.
+
+    max_age: If specified, only wins less than this many days old.
+    """
+    return _shortest_wins(
+        s, limit=limit, player=player, max_age=max_age).all()
 
 
 def combo_highscore_holders(s: sqlalchemy.orm.session.Session,
@@ -691,15 +978,25 @@ def combo_highscore_holders(s: sqlalchemy.orm.session.Session,
 
 
 def get_gobal_records(s: sqlalchemy.orm.session.Session) -> dict:
-    """Convenience function to return all classes of highscores."""
-    out = {
-        'combo': combo_highscores(s),
-        'species': species_highscores(s),
-        'background': background_highscores(s),
-        'god': god_highscores(s),
-        'shortest': shortest_wins(s),
-        'fastest': fastest_wins(s),
-    }
+    """Return every class of highscore, indexed by the player who holds it.
+
+    Returns a dict of form {player_id: {board: [game, ...]}, ...}, where
+    board is one of 'combo', 'species', 'background', 'god', 'shortest' or
+    'fastest'. Players without any records are not included. Games keep
+    the order of their board.
+    """
+    boards = (
+        ('combo', combo_highscores(s)),
+        ('species', species_highscores(s)),
+        ('background', background_highscores(s)),
+        ('god', god_highscores(s)),
+        ('shortest', shortest_wins(s)),
+        ('fastest', fastest_wins(s)), )
+    out = {}  # type: dict
+    for board, games in boards:
+        for game in games:
+            out.setdefault(game.player_id, {}).setdefault(board,
+                                                          []).append(game)
     return out
 
 
@@ -715,6 +1012,88 @@ def get_player_streak(s: sqlalchemy.orm.session.Session,
     return q.one_or_none()
 
 
+def player_page_data(s: sqlalchemy.orm.session.Session,
+                     player_ids: Sequence[int],
+                     *,
+                     recent: int=const.PLAYER_TABLE_LENGTH) -> dict:
+    """Fetch everything shown on the pages of a group of players.
+
+    This issues the same handful of queries however many players are
+    passed, so callers should pass players in groups of a few hundred.
+    Players' achievements and accounts are loaded into the session too, so
+    rendering doesn't lazy-load them one at a time.
+
+    Parameters:
+        player_ids: the players to fetch
+        recent: number of recent games to fetch per player
+
+    Returns:
+        Dict of form {player_id: {'n_games': int, 'n_boring_games': int,
+        'total_dur': int, 'highscore': Game, 'won_games': [Game, ...],
+        'recent_games': [Game, ...], 'active_streak': Streak or None}}.
+        Games are most recent first. Players without games are left out.
+    """
+    if not player_ids:
+        return {}
+    out = {}  # type: dict
+    stats = s.query(Game.player_id,
+                    func.count(Game.gid),
+                    func.sum(sqlalchemy.case([(Game.boring, 1)], else_=0)),
+                    func.sum(Game.dur)).filter(
+                        Game.player_id.in_(player_ids)).group_by(
+                            Game.player_id)
+    for player_id, n_games, n_boring_games, total_dur in stats:
+        out[player_id] = {
+            'n_games': n_games,
+            'n_boring_games': n_boring_games,
+            'total_dur': total_dur,
+            'highscore': None,
+            'won_games': [],
+            'recent_games': [],
+            'active_streak': None,
+        }
+
+    # Each player's most recent games and top scoring game in one query
+    ranked = s.query(
+        Game,
+        func.row_number().over(
+            partition_by=Game.player_id,
+            order_by=Game.end.desc()).label('recent_rank'),
+        func.row_number().over(
+            partition_by=Game.player_id,
+            order_by=Game.score.desc()).label('score_rank')).filter(
+                Game.player_id.in_(player_ids)).subquery()
+    ranked_game = sqlalchemy.orm.aliased(Game, ranked)
+    q = s.query(ranked_game, ranked.c.recent_rank,
+                ranked.c.score_rank).filter(
+                    sqlalchemy.or_(ranked.c.recent_rank <= recent,
+                                   ranked.c.score_rank == 1)).order_by(
+                                       ranked.c.recent_rank)
+    for game, recent_rank, score_rank in q:
+        if recent_rank <= recent:
+            out[game.player_id]['recent_games'].append(game)
+        if score_rank == 1:
+            out[game.player_id]['highscore'] = game
+
+    won = s.query(Game).filter(Game.player_id.in_(player_ids),
+                               Game.won == sqlalchemy.true()).order_by(
+                                   Game.end.desc())
+    for game in won:
+        out[game.player_id]['won_games'].append(game)
+
+    streaks = s.query(Streak).filter(
+        Streak.player_id.in_(player_ids),
+        Streak.active == sqlalchemy.true()).options(
+            sqlalchemy.orm.selectinload(Streak.games))
+    for streak in streaks:
+        out[streak.player_id]['active_streak'] = streak
+
+    s.query(Player).filter(Player.id.in_(player_ids)).options(
+        sqlalchemy.orm.selectinload(Player.achievements),
+        sqlalchemy.orm.selectinload(Player.accounts)).all()
+    return out
+
+
 def get_streaks(s: sqlalchemy.orm.session.Session,
                 active: Optional[bool]=None,
                 limit: Optional[int]=None,
@@ -739,13 +1118,15 @@ def get_streaks(s: sqlalchemy.orm.session.Session,
     # HAVING streak_length > 1
     # ORDER BY streak_length DESC
     streak_length = func.count(Game.streak_id).label('streak_length')
-    streak_last_activity = func.max(Game.end).label('streak_last_activity')
     q = s.query(Streak, streak_length).join(Streak.games)
+    if max_age is not None:
+        # Restrict to streaks with a recent game before aggregating. The
+        # subquery is a range scan on the Game.end index.
+        recent_streaks = s.query(Game.streak_id).filter(
+            _in_window(max_age), Game.streak_id.isnot(None))
+        q = q.filter(Streak.id.in_(recent_streaks.subquery()))
     q = q.group_by(Streak.id)
     q = q.having(streak_length > 1)
-    if max_age is not None:
-        q = q.having(
-            streak_last_activity > func.date('now', '-%s day' % max_age))
     q = q.order_by(streak_length.desc())
     if active is not None:
         q = q.filter(Streak.active == (sqlalchemy.true()
@@ -772,9 +1153,134 @@ def get_old_player_pages(s: sqlalchemy.orm.session.Session,
     return s.query(Player).order_by(Player.page_updated).limit(num).all()
 
 
-def updated_player_page(s: sqlalchemy.orm.session.Session,
-                        player: Player) -> None:
-    """Mark a player's page as having been updated."""
-    p = s.query(Player).filter(Player.id == player.id).one()
-    p.page_updated = datetime.datetime.now()
-    s.add(p)
+def player_page_key(player_id: int) -> str:
+    """Return the dirty_pages key of a player's page."""
+    return '%s%s' % (PLAYER_PAGE_PREFIX, player_id)
+
+
+def enqueue_dirty_pages(s: sqlalchemy.orm.session.Session,
+                        pages: Dict[str, str],
+                        batch_size: int=500) -> None:
+    """Queue pages to be rebuilt, in the caller's transaction.
+
+    Pages which are already queued have their enqueued_at updated, so a
+    build which read the old entry won't remove the new one (see
+    remove_dirty_pages).
+
+    Parameters:
+        pages: dict of form {page key: reason}, reason from DIRTY_REASONS
+    """
+    now = datetime.datetime.now()
+    keys = sorted(pages)
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        existing = dict(
+            s.query(DirtyPage.page, DirtyPage.reason).filter(
+                DirtyPage.page.in_(batch)))
+        s.bulk_insert_mappings(DirtyPage, [{
+            'page': page,
+            'reason': pages[page],
+            'enqueued_at': now
+        } for page in batch if page not in existing])
+        # One UPDATE per resulting reason
+        updates = {}  # type: Dict[str, List[str]]
+        for page, reason in existing.items():
+            reason = min(reason, pages[page], key=DIRTY_REASONS.index)
+            updates.setdefault(reason, []).append(page)
+        for reason, group in updates.items():
+            s.query(DirtyPage).filter(DirtyPage.page.in_(group)).update(
+                {
+                    DirtyPage.reason: reason,
+                    DirtyPage.enqueued_at: now
+                },
+                synchronize_session=False)
+
+
+def get_dirty_pages(s: sqlalchemy.orm.session.Session,
+                    prefix: str='') -> Sequence[Tuple[str, str,
+                                                      datetime.datetime]]:
+    """Return (page key, reason, enqueued_at) of queued pages, oldest first.
+
+    Parameters:
+        prefix: only pages whose key starts with this, eg 'player:'
+    """
+    q = s.query(DirtyPage.page, DirtyPage.reason, DirtyPage.enqueued_at)
+    if prefix:
+        q = q.filter(DirtyPage.page.startswith(prefix))
+    return q.order_by(DirtyPage.enqueued_at).all()
+
+
+def remove_dirty_pages(s: sqlalchemy.orm.session.Session,
+                       pages: Sequence[Tuple[str, datetime.datetime]],
+                       batch_size: int=500) -> None:
+    """Remove rebuilt pages from the queue.
+
+    Parameters:
+        pages: (page key, enqueued_at) as read by get_dirty_pages. Pages
+            which have been queued again since aren't removed.
+    """
+    by_time = {}  # type: Dict[datetime.datetime, List[str]]
+    for page, enqueued_at in pages:
+        by_time.setdefault(enqueued_at, []).append(page)
+    for enqueued_at, group in by_time.items():
+        for i in range(0, len(group), batch_size):
+            s.query(DirtyPage).filter(
+                DirtyPage.enqueued_at == enqueued_at,
+                DirtyPage.page.in_(group[i:i + batch_size])).delete(
+                    synchronize_session=False)
+
+
+def updated_player_pages(s: sqlalchemy.orm.session.Session,
+                         player_ids: Sequence[int],
+                         batch_size: int=500) -> None:
+    """Mark players' pages as having been updated.
+
+    Issues one UPDATE per batch_size players.
+    """
+    now = datetime.datetime.now()
+    for i in range(0, len(player_ids), batch_size):
+        s.query(Player).filter(
+            Player.id.in_(player_ids[i:i + batch_size])).update(
+                {Player.page_updated: now}, synchronize_session=False)
+
+
+def explain(s: sqlalchemy.orm.session.Session,
+            q: sqlalchemy.orm.query.Query) -> Sequence[str]:
+    """Return the database's query plan for a query, one line per step."""
+    compiled = q.statement.compile(dialect=s.bind.dialect)
+    if compiled.positional:
+        params = tuple(
+            compiled.params[k]
+            for k in compiled.positiontup)  # type: ignore
+    else:
+        params = compiled.params  # type: ignore
+    if s.bind.dialect.name == 'sqlite':
+        rows = s.connection().execute('EXPLAIN QUERY PLAN %s' % compiled,
+                                      params)
+        return [row[-1] for row in rows]
+    else:
+        rows = s.connection().execute('EXPLAIN %s' % compiled, params)
+        return [row[0] for row in rows]
+
+
+def check_winning_indexes(
+        s: sqlalchemy.orm.session.Session) -> Sequence[Tuple[str, str, bool]]:
+    """Check the leaderboard queries use the partial won game indexes.
+
+    Returns a list of (query name, expected index, index used) tuples.
+    """
+    queries = [
+        ('fastest_wins', 'won_dur_index', _fastest_wins(s)),
+        ('shortest_wins', 'won_turn_index', _shortest_wins(s)),
+        ('recent wins', 'won_end_index',
+         _games(s, winning=True, limit=const.FRONTPAGE_TABLE_LENGTH)),
+    ]
+    player = s.query(Player).first()
+    if player is not None:
+        queries.append(('player wins', 'won_player_index',
+                        _games(s, player=player, winning=True)))
+    results = []
+    for name, index, q in queries:
+        plan = explain(s, q)
+        results.append((name, index, any(index in line for line in plan)))
+    return results
@@ -1,6 +1,10 @@
 """Basic data model."""
 
+import os
+import json
+import hashlib
 import sqlite3  # for typing
+from typing import Optional, Sequence
 
 import characteristic
 
@@ -10,13 +14,20 @@ from sqlalchemy import Table, Column, String, Integer, Boolean, DateTime, \
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+import sqlalchemy.exc
 import sqlalchemy.pool
 import sqlalchemy.ext.declarative.api
 
+import scoreboard.constants as const
+
 Base = declarative_base(
 )  # type: sqlalchemy.ext.declarative.api.DeclarativeMeta
 
 Session = None
+ReadOnlySession = None
+# Arguments of the last setup_database call, so worker processes can
+# connect to the same database
+DATABASE_OPTIONS = None  # type: Optional[dict]
 
 
 @characteristic.with_repr(["name"])  # pylint: disable=too-few-public-methods
@@ -293,6 +304,10 @@ class Game(Base):
         potions_use:
         scrolls_used
         scored: Has the game been procssed by scoring yet?
+        won: Was the game won? Denormalised from ktyp.
+        boring: Was the game quit, left, or wizmoded? Denormalised from ktyp.
+        char: Character code eg 'MiFi'. Denormalised from species and
+            background.
     """
 
     __tablename__ = 'games'
@@ -343,6 +358,19 @@ class Game(Base):
         Integer, ForeignKey('ktyps.id'), nullable=False)  # type: int
     ktyp = relationship("Ktyp")
 
+    # Denormalised data. Set on game record insertion
+    won = Column(
+        Boolean,
+        nullable=False,
+        default=False,
+        server_default=sqlalchemy.false())  # type: bool
+    boring = Column(
+        Boolean,
+        nullable=False,
+        default=False,
+        server_default=sqlalchemy.false())  # type: bool
+    char = Column(String(4), nullable=False, server_default='')  # type: str
+
     scored = Column(
         Boolean, default=False, nullable=False, index=True)  # type: bool
 
@@ -352,16 +380,43 @@ class Game(Base):
 
     __table_args__ = (
         # Used to find various highscores in model
-        # XXX: these indexes should have a sqlite_where=ktyp_id == 'winning'
-        # But these indexes can then only be added after the 'winning' ktyp is
-        # added.... chicken & egg.
         Index('species_highscore_index', species_id, score),
         Index('background_highscore_index', background_id, score),
         Index('combo_highscore_index', species_id, background_id, score),
-        Index('fastest_highscore_index', ktyp_id, dur),
-        Index('shortest_highscore_index', ktyp_id, turn),
+        # Used for player page stats
+        Index('player_boring_index', player_id, boring),
+        # Used for leaderboards and lists of winning games. A plain index on
+        # won would be preferred by the planner but can't help with ordering.
+        Index(
+            'won_score_index',
+            score,
+            postgresql_where=won == sqlalchemy.true(),
+            sqlite_where=won == sqlalchemy.true()),
+        Index(
+            'won_dur_index',
+            dur,
+            postgresql_where=won == sqlalchemy.true(),
+            sqlite_where=won == sqlalchemy.true()),
+        Index(
+            'won_turn_index',
+            turn,
+            postgresql_where=won == sqlalchemy.true(),
+            sqlite_where=won == sqlalchemy.true()),
+        Index(
+            'won_end_index',
+            end,
+            postgresql_where=won == sqlalchemy.true(),
+            sqlite_where=won == sqlalchemy.true()),
+        Index(
+            'won_player_index',
+            player_id,
+            end,
+            postgresql_where=won == sqlalchemy.true(),
+            sqlite_where=won == sqlalchemy.true()),
         # Used by scoring.score_games
         Index('unscored_games', scored, end),
+        # Used by model.iter_games for keyset pagination
+        Index('end_gid_index', end, gid),
         # Used by scoring.is_grief
         Index('first_game_index', account_id, end), )
 
@@ -370,26 +425,11 @@ class Game(Base):
         """Convenience shortcut."""
         return self.account.player
 
-    @property
-    def won(self) -> bool:
-        """Was this game won."""
-        return self.ktyp.name == 'winning'
-
     @property
     def quit(self) -> bool:
         """Was this game quit."""
         return self.ktyp.name == 'quitting'
 
-    @property
-    def boring(self) -> bool:
-        """Was this game was quit, left, or wizmoded."""
-        return self.ktyp.name in ('quitting', 'leaving', 'wizmode')
-
-    @property
-    def char(self) -> str:
-        """Character code eg 'MiFi'."""
-        return '{}{}'.format(self.species.short, self.background.short)
-
     @property
     def pretty_tmsg(self) -> str:
         """Pretty tmsg, more suitable for scoreboard display."""
@@ -441,6 +481,37 @@ class LogfileProgress(Base):
     current_key = Column(Integer, default=0, nullable=False)  # type: int
 
 
+@characteristic.with_repr(["key"])  # pylint: disable=too-few-public-methods
+class Setting(Base):
+    """Miscellaneous persistent state, as key/value pairs.
+
+    Columns:
+        key: name of the setting, eg 'constants_hash'
+        value: the setting's value
+    """
+
+    __tablename__ = 'settings'
+    key = Column(String(50), primary_key=True)  # type: str
+    value = Column(String(200), nullable=False)  # type: str
+
+
+@characteristic.with_repr(["page"])  # pylint: disable=too-few-public-methods
+class DirtyPage(Base):
+    """A website page which needs to be rebuilt.
+
+    Columns:
+        page: key of the page, eg 'player:123' (see model.player_page_key)
+        reason: why it needs rebuilding, eg 'new_games'
+        enqueued_at: when it was (last) marked dirty
+    """
+
+    __tablename__ = 'dirty_pages'
+    page = Column(String(100), primary_key=True)  # type: str
+    reason = Column(String(20), nullable=False)  # type: str
+    enqueued_at = Column(
+        DateTime, nullable=False, index=True)  # type: DateTime
+
+
 @characteristic.with_repr(["key"])  # pylint: disable=too-few-public-methods
 class Achievement(Base):
     """Achievements.
@@ -474,46 +545,272 @@ def sqlite_performance_over_safety(
     dbapi_con.execute('PRAGMA synchronous = OFF')
 
 
-def setup_database(*, database: str, path: str, credentials: str) -> None:
-    """Set up the database and create the master sessionmaker."""
+def sqlite_read_only(
+        dbapi_con: sqlite3.Connection,
+        con_record: sqlalchemy.pool.
+        _ConnectionRecord  # pylint: disable=protected-access
+) -> None:
+    """Refuse writes on read-only connections, even if the URI allows them."""
+    con_record  # pylint: disable=pointless-statement
+    dbapi_con.execute('PRAGMA query_only = ON')
+
+
+def postgres_read_only(
+        dbapi_con: object,
+        con_record: sqlalchemy.pool.
+        _ConnectionRecord  # pylint: disable=protected-access
+) -> None:
+    """Make every transaction on the connection read-only."""
+    con_record  # pylint: disable=pointless-statement
+    cursor = dbapi_con.cursor()  # type: ignore
+    cursor.execute('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+    cursor.close()
+    dbapi_con.commit()  # type: ignore
+
+
+def create_missing_indexes(engine: sqlalchemy.engine.Engine) -> None:
+    """Create indexes declared on existing tables but missing from the db.
+
+    create_all() only creates indexes along with new tables, so this adds
+    indexes declared after a table was first created.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                print("Adding index '%s'" % index.name)
+                index.create(engine)
+
+
+def schema_hash() -> str:
+    """Return a hash of the tables, columns and indexes declared here."""
+    data = [[
+        table.name,
+        sorted('%s %s %s' % (c.name, c.type, c.nullable)
+               for c in table.columns),
+        sorted(i.name for i in table.indexes),
+    ] for table in Base.metadata.sorted_tables]
+    return hashlib.sha1(json.dumps(data).encode('utf8')).hexdigest()
+
+
+def read_settings(engine: sqlalchemy.engine.Engine) -> dict:
+    """Return all settings as a dict, or {} for a new database."""
+    try:
+        rows = engine.execute(
+            sqlalchemy.select([Setting.key, Setting.value])).fetchall()
+    except sqlalchemy.exc.DBAPIError:
+        return {}
+    return dict(rows)
+
+
+def add_missing_columns(engine: sqlalchemy.engine.Engine) -> Sequence[str]:
+    """Add columns declared on existing tables but missing from the db.
+
+    Like indexes, create_all() doesn't add columns to existing tables.
+    Added columns must be nullable or have a server_default.
+
+    Returns a list of added columns as 'table.column'.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            print("Adding column '%s.%s'" % (table.name, column.name))
+            engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                table.name,
+                sqlalchemy.schema.CreateColumn(column).compile(
+                    dialect=engine.dialect)))
+            added.append('%s.%s' % (table.name, column.name))
+    return added
+
+
+def backfill_game_columns(s: sqlalchemy.orm.session.Session) -> None:
+    """Populate the denormalised won/boring/char columns of existing games."""
+    import scoreboard.model as model
+    print("Backfilling denormalised game columns")
+    winning = model.get_ktyp(s, 'winning').id
+    boring = [model.get_ktyp(s, ktyp).id for ktyp in const.BORING_KTYPS]
+    species = sqlalchemy.select([Species.short]).where(
+        Species.id == Game.species_id).as_scalar()
+    background = sqlalchemy.select([Background.short]).where(
+        Background.id == Game.background_id).as_scalar()
+    s.execute(Game.__table__.update().values(
+        won=Game.ktyp_id == winning,
+        boring=Game.ktyp_id.in_(boring),
+        char=species + background))
+    s.commit()
+
+
+def _engine_options(*,
+                    pool_size: Optional[int],
+                    max_overflow: Optional[int],
+                    pool_recycle: Optional[int],
+                    pool_pre_ping: bool) -> dict:
+    """Build create_engine() keyword arguments for the connection pool.
+
+    If pool_size isn't specified, connections aren't pooled (NullPool) so
+    every session opens a fresh connection.
+    """
+    opts = {}  # type: dict
+    if pool_size is None:
+        opts['poolclass'] = sqlalchemy.pool.NullPool
+    else:
+        opts['poolclass'] = sqlalchemy.pool.QueuePool
+        opts['pool_size'] = pool_size
+        if max_overflow is not None:
+            opts['max_overflow'] = max_overflow
+    if pool_recycle is not None:
+        opts['pool_recycle'] = pool_recycle
+    if pool_pre_ping:
+        opts['pool_pre_ping'] = True
+    return opts
+
+
+def _database_uri(*,
+                  database: str,
+                  path: str,
+                  credentials: str,
+                  host: str,
+                  port: Optional[int],
+                  dbname: str) -> str:
+    """Build the SQLAlchemy URI for the primary database."""
     if database == 'sqlite':
-        db_uri = 'sqlite:///{database_path}'.format(database_path=path)
+        return 'sqlite:///{database_path}'.format(database_path=path)
     elif database == 'postgres':
-        db_uri = 'postgresql+psycopg2://{creds}localhost/scoreboard'
-        if credentials:
-            db_uri = db_uri.format(creds='%s@' % credentials)
-        else:
-            db_uri = db_uri.format(creds='')
+        return 'postgresql+psycopg2://{creds}{host}{port}/{dbname}'.format(
+            creds='%s@' % credentials if credentials else '',
+            host=host,
+            port=':%s' % port if port else '',
+            dbname=dbname)
     else:
         raise ValueError("Unknown database type!")
+
+
+def _readonly_database_uri(*, database: str, path: str, db_uri: str) -> str:
+    """Build the SQLAlchemy URI for a read-only engine on the primary db."""
+    if database == 'sqlite':
+        return 'sqlite:///file:{database_path}?mode=ro&uri=true'.format(
+            database_path=os.path.abspath(path))
+    return db_uri
+
+
+def setup_database(*,
+                   database: str,
+                   path: str,
+                   credentials: str,
+                   host: str='localhost',
+                   port: Optional[int]=None,
+                   dbname: str='scoreboard',
+                   pool_size: Optional[int]=None,
+                   max_overflow: Optional[int]=None,
+                   pool_recycle: Optional[int]=None,
+                   pool_pre_ping: bool=False,
+                   readonly: bool=False,
+                   replica_uri: Optional[str]=None) -> None:
+    """Set up the database and create the master sessionmaker.
+
+    Parameters:
+        database: 'sqlite' or 'postgres'
+        path: database path (sqlite only)
+        credentials: 'user:password' (postgres only)
+        host, port, dbname: database location (postgres only)
+        pool_size: connections kept open per engine. If not specified,
+            connections aren't pooled.
+        max_overflow: connections allowed above pool_size
+        pool_recycle: recycle connections older than this many seconds
+        pool_pre_ping: test connections for liveness on checkout
+        readonly: create a separate read-only engine for
+            get_session(readonly=True). For sqlite this opens the database
+            file with mode=ro, for postgres all transactions are read-only.
+        replica_uri: SQLAlchemy URI of a read replica to use for the
+            read-only engine. Implies readonly.
+    """
+    global DATABASE_OPTIONS  # pylint: disable=global-statement
+    DATABASE_OPTIONS = {
+        'database': database,
+        'path': path,
+        'credentials': credentials,
+        'host': host,
+        'port': port,
+        'dbname': dbname,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': pool_pre_ping,
+        'readonly': readonly,
+        'replica_uri': replica_uri,
+    }
+    db_uri = _database_uri(
+        database=database,
+        path=path,
+        credentials=credentials,
+        host=host,
+        port=port,
+        dbname=dbname)
+    engine_opts = _engine_options(
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping)
     print("Connecting to {}".format(db_uri))
-    engine_opts = {'poolclass': sqlalchemy.pool.NullPool}
     engine = sqlalchemy.create_engine(db_uri, **engine_opts)
 
     if db_uri.startswith('sqlite'):
         sqlalchemy.event.listen(engine, 'connect',
                                 sqlite_performance_over_safety)
 
-    Base.metadata.create_all(engine)
+    settings = read_settings(engine)
+    new_schema_hash = schema_hash()
+    added_columns = []  # type: Sequence[str]
+    if settings.get('schema_hash') != new_schema_hash:
+        Base.metadata.create_all(engine)
+        added_columns = add_missing_columns(engine)
+        create_missing_indexes(engine)
 
-    # Create the global session manager
-    global Session  # pylint: disable=global-statement
+    # Create the global session managers
+    global Session, ReadOnlySession  # pylint: disable=global-statement
     Session = sessionmaker(bind=engine)
 
+    if readonly or replica_uri:
+        ro_uri = replica_uri or _readonly_database_uri(
+            database=database, path=path, db_uri=db_uri)
+        print("Connecting to {} (read-only)".format(ro_uri))
+        ro_engine = sqlalchemy.create_engine(ro_uri, **engine_opts)
+        if ro_uri.startswith('sqlite'):
+            sqlalchemy.event.listen(ro_engine, 'connect', sqlite_read_only)
+        else:
+            sqlalchemy.event.listen(ro_engine, 'connect', postgres_read_only)
+        ReadOnlySession = sessionmaker(bind=ro_engine)
+    else:
+        ReadOnlySession = None
+
     sess = Session()
 
     import scoreboard.model as model
-    model.setup_species(sess)
-    model.setup_backgrounds(sess)
-    model.setup_gods(sess)
-    model.setup_branches(sess)
-    model.setup_achievements(sess)
-    model.setup_ktyps(sess)
+    model.setup_constants(sess, settings)
+    if {'games.won', 'games.boring', 'games.char'} & set(added_columns):
+        backfill_game_columns(sess)
+    if settings.get('schema_hash') != new_schema_hash:
+        model.set_setting(sess, 'schema_hash', new_schema_hash)
+        sess.commit()
+
 
+def get_session(readonly: bool=False) -> sqlalchemy.orm.session.Session:
+    """Create a new database session.
 
-def get_session() -> sqlalchemy.orm.session.Session:
-    """Create a new database session."""
+    If readonly is True and a read-only engine was configured, the session
+    uses that engine. Otherwise the normal read-write engine is used.
+    """
     if Session is None:
         raise Exception(
             "Database hasn't been initialised, run setup_database() first!")
+    if readonly and ReadOnlySession is not None:
+        return ReadOnlySession()
     return Session()
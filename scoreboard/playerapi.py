@@ -0,0 +1,248 @@
+"""Write the paginated player game history API (api/2).
+
+For each player there is an index document, api/2/player/<name>/index.json,
+and their games split into fixed-size pages, api/2/player/<name>/<n>.json.
+Pages are numbered from the player's first game, so page 0 holds their
+oldest PAGE_SIZE games and only the last page is partly filled. New games
+only ever change the last page (or add new ones), so only those are
+rewritten. The index lists pages newest first, and games within a page are
+newest first, so recent activity is in the first page listed.
+
+Games are read in keyset-paginated batches of raw columns, one batch per
+page, and encoded straight into the page file as compact JSON.
+"""
+
+import os
+import json
+import calendar
+import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import sqlalchemy
+import sqlalchemy.orm  # for sqlalchemy.orm.session.Session type hints
+from sqlalchemy import func
+
+from . import model
+from . import orm
+from . import sitewriter
+
+API_DIR = 'api/2/player'
+PAGE_SIZE = 100
+# Bump to rewrite every page after changing the format
+FORMAT_VERSION = 1
+
+# (key, Game column). Columns ending in _id are looked up in get_lookups.
+COLUMNS = (
+    ('gid', orm.Game.gid),
+    ('account_id', orm.Game.account_id),
+    ('version_id', orm.Game.version_id),
+    ('species_id', orm.Game.species_id),
+    ('background_id', orm.Game.background_id),
+    ('char', orm.Game.char),
+    ('place_id', orm.Game.place_id),
+    ('god_id', orm.Game.god_id),
+    ('ktyp_id', orm.Game.ktyp_id),
+    ('xl', orm.Game.xl),
+    ('tmsg', orm.Game.tmsg),
+    ('turns', orm.Game.turn),
+    ('dur', orm.Game.dur),
+    ('runes', orm.Game.runes),
+    ('score', orm.Game.score),
+    ('start', orm.Game.start),
+    ('end', orm.Game.end), )
+
+
+def epoch(d: datetime.datetime) -> int:
+    """Convert a (naive, UTC) datetime to a unix timestamp."""
+    return calendar.timegm(d.utctimetuple())
+
+
+def get_lookups(s: sqlalchemy.orm.session.Session) -> Dict[str, dict]:
+    """Return {column key: {id: value}} for the id columns."""
+    places = s.query(orm.Place.id, orm.Place.level, orm.Branch.short,
+                     orm.Branch.multilevel).join(orm.Place.branch)
+    accounts = s.query(orm.Account.id, orm.Account.name,
+                       orm.Server.name).join(orm.Account.server)
+    return {
+        'account_id': {i: (name, server)
+                       for i, name, server in accounts},
+        'version_id': dict(s.query(orm.Version.id, orm.Version.v)),
+        'species_id': dict(s.query(orm.Species.id, orm.Species.name)),
+        'background_id':
+        dict(s.query(orm.Background.id, orm.Background.name)),
+        'place_id': {
+            i: '%s:%s' % (br, lvl) if multilevel else br
+            for i, lvl, br, multilevel in places
+        },
+        'god_id': dict(s.query(orm.God.id, orm.God.name)),
+        'ktyp_id': dict(s.query(orm.Ktyp.id, orm.Ktyp.name)),
+    }
+
+
+def game_dict(row: Sequence, player_name: str, lookups: Dict[str,
+                                                             dict]) -> dict:
+    """Convert a row of COLUMNS to an API game dict.
+
+    The fields match orm.Game.as_dict, plus ktyp, with start and end as
+    unix timestamps.
+    """
+    values = dict(zip((key for key, _ in COLUMNS), row))
+    account_name, server_name = lookups['account_id'][values['account_id']]
+    return {
+        'gid': values['gid'],
+        'account_name': account_name,
+        'player_name': player_name,
+        'server_name': server_name,
+        'version': lookups['version_id'][values['version_id']],
+        'species': lookups['species_id'][values['species_id']],
+        'background': lookups['background_id'][values['background_id']],
+        'char': values['char'],
+        'place': lookups['place_id'][values['place_id']],
+        'god': lookups['god_id'][values['god_id']],
+        'ktyp': lookups['ktyp_id'][values['ktyp_id']],
+        'xl': values['xl'],
+        'tmsg': values['tmsg'],
+        'turns': values['turns'],
+        'dur': values['dur'],
+        'runes': values['runes'],
+        'score': values['score'],
+        'start': epoch(values['start']),
+        'end': epoch(values['end']),
+    }
+
+
+def _encode(obj: object) -> str:
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+def _read_index(writer: sitewriter.SiteWriter, path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(writer.root, path), encoding='utf8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != FORMAT_VERSION:
+        return None
+    return index
+
+
+def _count_games(s: sqlalchemy.orm.session.Session,
+                 player: orm.Player,
+                 last: Tuple[datetime.datetime, str]) -> int:
+    """Count a player's games up to and including keyset last."""
+    end, gid = last
+    return s.query(orm.Game).filter(
+        orm.Game.player_id == player.id, orm.Game.end <= end,
+        sqlalchemy.or_(orm.Game.end < end, orm.Game.gid <= gid)).count()
+
+
+def _full_pages(s: sqlalchemy.orm.session.Session,
+                player: orm.Player,
+                index: Optional[dict]) -> List[dict]:
+    """Return the existing pages of an index which don't need rewriting.
+
+    These are the full pages, provided no games have been imported since
+    which sort before their end (which would shift every later page).
+    """
+    if index is None:
+        return []
+    pages = sorted(
+        (p for p in index['pages'] if p['games'] == PAGE_SIZE),
+        key=lambda p: p['page'])
+    if not pages:
+        return []
+    last = pages[-1]['last']
+    keyset = (datetime.datetime.utcfromtimestamp(last[0]), last[1])
+    if _count_games(s, player, keyset) != len(pages) * PAGE_SIZE:
+        return []
+    return pages
+
+
+def write_player_games(s: sqlalchemy.orm.session.Session,
+                       writer: sitewriter.SiteWriter,
+                       player: orm.Player,
+                       lookups: Dict[str, dict],
+                       index: Optional[dict]) -> None:
+    """Write the changed game pages and the index of one player."""
+    directory = '%s/%s' % (API_DIR, player.url_name)
+    os.makedirs(os.path.join(writer.root, directory), exist_ok=True)
+    pages = _full_pages(s, player, index)
+    after = None
+    if pages:
+        last = pages[-1]['last']
+        after = (datetime.datetime.utcfromtimestamp(last[0]), last[1])
+
+    columns = [col for _, col in COLUMNS]
+    for batch in model.iter_game_batches(
+            s,
+            player=player,
+            reverse_order=True,
+            batch_size=PAGE_SIZE,
+            after=after,
+            columns=columns):
+        n = len(pages)
+        with writer.open('%s/%s.json' % (directory, n)) as f:
+            f.write('{"games":[')
+            for i, row in enumerate(reversed(batch)):
+                if i:
+                    f.write(',')
+                f.write(_encode(game_dict(row, player.name, lookups)))
+            f.write('],"page":%s,"player":%s}' % (n, _encode(player.name)))
+        pages.append({
+            'page': n,
+            'games': len(batch),
+            'first': [epoch(batch[0].end), batch[0].gid],
+            'last': [epoch(batch[-1].end), batch[-1].gid],
+        })
+
+    # Pages past the end can only be left over from before a rebuild
+    if index is not None:
+        for page in index['pages']:
+            if page['page'] >= len(pages):
+                writer.remove('%s/%s.json' % (directory, page['page']))
+
+    writer.write(directory + '/index.json',
+                 _encode({
+                     'version': FORMAT_VERSION,
+                     'player': player.name,
+                     'games': sum(p['games'] for p in pages),
+                     'page_size': PAGE_SIZE,
+                     'pages': pages[::-1],
+                 }))
+
+
+def write_player_api(s: sqlalchemy.orm.session.Session,
+                     writer: sitewriter.SiteWriter,
+                     players: Iterable[orm.Player],
+                     batch_size: int=500) -> None:
+    """Write the game history API of players with new games.
+
+    A player is skipped without any further queries when their index
+    already has as many games as they've played and ends with their latest
+    game. Game counts are read for batch_size players per query.
+    """
+    print("Writing player API v2 pages")
+    players = list(players)
+    stats = {}  # type: Dict[int, Tuple[int, int]]
+    for i in range(0, len(players), batch_size):
+        ids = [p.id for p in players[i:i + batch_size]]
+        for player_id, n, end in s.query(
+                orm.Game.player_id, func.count(orm.Game.gid),
+                func.max(orm.Game.end)).filter(
+                    orm.Game.player_id.in_(ids)).group_by(
+                        orm.Game.player_id):
+            stats[player_id] = (n, epoch(end))
+    lookups = None  # type: Optional[Dict[str, dict]]
+    updated = 0
+    for player in players:
+        n, end = stats.get(player.id, (0, None))
+        path = '%s/%s/index.json' % (API_DIR, player.url_name)
+        index = _read_index(writer, path)
+        if index is not None and index['games'] == n and (
+                not index['pages'] or index['pages'][0]['last'][0] == end):
+            continue
+        if lookups is None:
+            lookups = get_lookups(s)
+        write_player_games(s, writer, player, lookups, index)
+        updated += 1
+    print("Updated API v2 pages of %s players" % updated)
@@ -0,0 +1,110 @@
+"""Write the sharded player name index used for search autocomplete.
+
+Player names are split into shards by the first character of their
+lowercased name (static/players/a.json), so the search box only fetches
+names which could match what's been typed, from the first keystroke. Each
+shard is a sorted JSON list of names. A shard with more than SHARD_LIMIT
+names is split into shards one character longer, and replaced with
+{"split": true, "names": [...], "preview": [...]}. names lists just the
+names no longer than the prefix, and preview the names the search box
+would show when exactly the prefix has been typed.
+
+static/players/index.json records a hash of all player names; the shards
+are only regenerated when it changes, ie when new players appear.
+"""
+
+import os
+import re
+import json
+import hashlib
+from typing import Dict, Iterable, List, Sequence
+
+from . import sitewriter
+
+INDEX_DIR = 'static/players'
+INDEX = INDEX_DIR + '/index.json'
+PREFIX_LENGTH = 1
+SHARD_LIMIT = 1000
+# Awesomplete's default maxItems. Its default sort puts shorter names first.
+PREVIEW_SIZE = 10
+# Bump to rebuild the index after changing its layout
+INDEX_VERSION = 2
+
+# Characters which can't go in a shard filename
+UNSAFE_PATTERN = re.compile(r'[^a-z0-9]')
+
+
+def shard_key(prefix: str) -> str:
+    """Return the shard name for a (lowercase) name prefix."""
+    return UNSAFE_PATTERN.sub('_', prefix)
+
+
+def _names_hash(names: Sequence[str]) -> str:
+    h = hashlib.sha1(str((INDEX_VERSION, SHARD_LIMIT)).encode())
+    for name in names:
+        h.update(name.encode('utf8') + b'\n')
+    return h.hexdigest()
+
+
+def shards(names: Iterable[str],
+           length: int=PREFIX_LENGTH,
+           limit: int=SHARD_LIMIT) -> Dict[str, object]:
+    """Split names into shards.
+
+    Returns:
+        Dict of form {shard key: sorted list of names}, with split shards
+        as {'split': True, 'names': [names no longer than the prefix],
+        'preview': [the PREVIEW_SIZE shortest names]}.
+    """
+    groups = {}  # type: Dict[str, List[str]]
+    for name in names:
+        groups.setdefault(shard_key(name.lower()[:length]), []).append(name)
+    out = {}  # type: Dict[str, object]
+    for key, group in groups.items():
+        group.sort(key=lambda n: (n.lower(), n))
+        longer = [n for n in group if len(n) > length]
+        if len(group) > limit and longer:
+            preview = sorted(group, key=lambda n: (len(n), n))
+            # Names no longer than the prefix can't be split any further
+            out[key] = {
+                'split': True,
+                'names': [n for n in group if len(n) <= length],
+                'preview': preview[:PREVIEW_SIZE]
+            }
+            out.update(shards(longer, length + 1, limit))
+        else:
+            out[key] = group
+    return out
+
+
+def write_player_index(writer: sitewriter.SiteWriter,
+                       names: Sequence[str]) -> None:
+    """Write the player name index, if the set of players changed."""
+    names = sorted(names)
+    names_hash = _names_hash(names)
+    path = os.path.join(writer.root, INDEX)
+    try:
+        with open(path, encoding='utf8') as f:
+            if json.load(f).get('hash') == names_hash:
+                print("Player index is up to date")
+                return
+    except (OSError, ValueError):
+        pass
+
+    print("Writing player index")
+    index = shards(names)
+    for key, shard in index.items():
+        writer.write('%s/%s.json' % (INDEX_DIR, key), json.dumps(shard))
+    # Remove shards left over from a different layout
+    for entry in os.scandir(os.path.join(writer.root, INDEX_DIR)):
+        key, ext = os.path.splitext(entry.name)
+        if ext == '.json' and key != 'index' and key not in index:
+            writer.remove('%s/%s' % (INDEX_DIR, entry.name))
+    writer.write(INDEX,
+                 json.dumps(
+                     {
+                         'hash': names_hash,
+                         'players': len(names),
+                         'shards': len(index)
+                     },
+                     sort_keys=True))
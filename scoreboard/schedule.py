@@ -0,0 +1,170 @@
+"""Choose which player pages to rebuild, most important first.
+
+Pages which need rebuilding are queued in the dirty_pages table (see
+model.enqueue_dirty_pages), and scheduled in priority order:
+1. NEW_GAMES: players with newly scored games, or named with --players.
+2. RECORDS: players who gained or lost a record since the last build.
+3. STALE: the least recently updated pages (--extra-player-pages).
+
+Queue entries are only removed once their page has been written, so with
+a time budget (or after a crash) the rest are scheduled on the next run.
+STALE pages are simply picked again, as they're still the least recently
+updated.
+"""
+
+import os
+import json
+import tempfile
+import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import sqlalchemy.orm  # for sqlalchemy.orm.session.Session type hints
+
+from . import model
+
+NEW_GAMES = 3
+RECORDS = 2
+STALE = 1
+PRIORITY_NAMES = {
+    NEW_GAMES: 'new games',
+    RECORDS: 'record changes',
+    STALE: 'stale',
+}
+
+# Priority of each model.DIRTY_REASONS reason
+REASON_PRIORITIES = {
+    model.DIRTY_NEW_GAMES: NEW_GAMES,
+    model.DIRTY_REQUESTED: NEW_GAMES,
+    model.DIRTY_RECORDS: RECORDS,
+}
+
+# Records held by each player at the last build, in the website dir
+RECORD_HOLDERS = '.record-holders.json'
+
+# (player id, priority, enqueued_at of their dirty_pages entry or None)
+Scheduled = Tuple[int, int, Optional[datetime.datetime]]
+
+
+def record_holders(global_records: dict) -> Dict[str, List[str]]:
+    """Summarise model.get_gobal_records output for change detection.
+
+    Returns a dict of form {player_id: ['board:gid', ...]}, with string
+    keys so it survives a round trip through JSON.
+    """
+    return {
+        str(player_id): sorted('%s:%s' % (board, g.gid)
+                               for board, games in boards.items()
+                               for g in games)
+        for player_id, boards in global_records.items()
+    }
+
+
+def changed_record_holders(root: str,
+                           holders: Dict[str, List[str]]) -> Set[int]:
+    """Return the ids of players whose records changed since the last build.
+
+    On the first build every record holder counts as changed.
+    """
+    try:
+        with open(os.path.join(root, RECORD_HOLDERS), encoding='utf8') as f:
+            previous = json.load(f)  # type: Dict[str, List[str]]
+    except (OSError, ValueError):
+        return set(int(pid) for pid in holders)
+    return set(
+        int(pid) for pid in set(previous) | set(holders)
+        if previous.get(pid) != holders.get(pid))
+
+
+def save_record_holders(root: str, holders: Dict[str, List[str]]) -> None:
+    """Atomically save record_holders output for the next build."""
+    fd, tmp = tempfile.mkstemp(dir=root, prefix='.%s.' % RECORD_HOLDERS)
+    with open(fd, 'w', encoding='utf8') as f:
+        json.dump(holders, f, sort_keys=True)
+    os.replace(tmp, os.path.join(root, RECORD_HOLDERS))
+
+
+def enqueue_record_changes(s: sqlalchemy.orm.session.Session, root: str,
+                           holders: Dict[str, List[str]]) -> None:
+    """Queue the pages of players whose records changed since the last build.
+
+    Once s is committed, the caller should save holders with
+    save_record_holders, for the next build to compare against.
+
+    Parameters:
+        root: the website dir
+        holders: from record_holders
+    """
+    changed = changed_record_holders(root, holders)
+    model.enqueue_dirty_pages(
+        s, {model.player_page_key(pid): model.DIRTY_RECORDS
+            for pid in changed})
+
+
+def enqueue_players(s: sqlalchemy.orm.session.Session,
+                    names: Iterable[str]) -> None:
+    """Queue the pages of players by name, eg from --players.
+
+    Unknown names are skipped with a warning, rather than creating players.
+    """
+    pages = {}  # type: Dict[str, str]
+    for name in names:
+        player = model.find_player(s, name)
+        if player is None:
+            print("Skipping unknown player %s" % name)
+            continue
+        pages[model.player_page_key(player.id)] = model.DIRTY_REQUESTED
+    model.enqueue_dirty_pages(s, pages)
+
+
+def _dirty_players(s: sqlalchemy.orm.session.Session) -> List[Scheduled]:
+    """Return the queued player pages, by priority then oldest first."""
+    prefix = model.PLAYER_PAGE_PREFIX
+    dirty = [(int(page[len(prefix):]),
+              REASON_PRIORITIES.get(reason, NEW_GAMES), enqueued_at)
+             for page, reason, enqueued_at in model.get_dirty_pages(s, prefix)]
+    return sorted(dirty, key=lambda x: (-x[1], x[2]))
+
+
+def _report(scheduled: List[Scheduled]) -> None:
+    counts = {}  # type: Dict[int, int]
+    for _, priority, _ in scheduled:
+        counts[priority] = counts.get(priority, 0) + 1
+    print("Scheduled %s player pages (%s)" % (len(scheduled), ', '.join(
+        '%s %s' % (counts.get(p, 0), name)
+        for p, name in sorted(PRIORITY_NAMES.items(), reverse=True))))
+
+
+def schedule_player_pages(s: sqlalchemy.orm.session.Session,
+                          *,
+                          extra: int) -> List[Scheduled]:
+    """Return the pages to rebuild, in rebuild order.
+
+    Queued pages come first, by priority and then oldest first, followed by
+    the least recently updated pages.
+
+    Parameters:
+        extra: also schedule this many of the least recently updated pages
+    """
+    scheduled = _dirty_players(s)
+    if extra:
+        queued = set(pid for pid, _, _ in scheduled)
+        scheduled.extend((p.id, STALE, None)
+                         for p in model.get_old_player_pages(s, extra)
+                         if p.id not in queued)
+    _report(scheduled)
+    return scheduled
+
+
+def schedule_all_players(s: sqlalchemy.orm.session.Session,
+                         player_ids: Iterable[int]) -> List[Scheduled]:
+    """Schedule every player's page, eg for --rebuild-player-pages.
+
+    Queued pages still come first, and are removed from the queue once
+    they're written.
+    """
+    scheduled = _dirty_players(s)
+    queued = set(pid for pid, _, _ in scheduled)
+    scheduled.extend(
+        (pid, STALE, None) for pid in player_ids if pid not in queued)
+    _report(scheduled)
+    return scheduled
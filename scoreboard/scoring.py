@@ -91,25 +91,37 @@ def score_game(s: sqlalchemy.orm.session.Session, game: orm.Game) -> None:
 
 
 def score_games() -> set:
-    """Score all unscored games."""
+    """Score all unscored games.
+
+    Each batch of games is scored in one transaction, which also queues
+    the pages of their players in dirty_pages. If anything fails, none of
+    the batch's games are marked scored.
+
+    Returns the names of those players.
+    """
     start = time.time()
     scored_players = set()
     s = orm.get_session()
     new_scored = 0
     print("Scoring games...")
-    while True:
-        games = model.list_games(
-            s, scored=False, limit=100, reverse_order=True)
-        if not games:
-            break
+    for games in model.iter_game_batches(
+            s, scored=False, reverse_order=True, batch_size=100):
+        player_ids = set()
         for game in games:
             score_game(s, game)
             game.scored = True
             s.add(game)
             scored_players.add(game.player.name)
+            player_ids.add(game.player_id)
             new_scored += 1
             if new_scored and new_scored % 10000 == 0:
                 print(new_scored)
+        model.enqueue_dirty_pages(
+            s, {
+                model.player_page_key(player_id): model.DIRTY_NEW_GAMES
+                for player_id in player_ids
+            })
+        model.bump_generation(s)
         s.commit()
 
     end = time.time()
@@ -0,0 +1,245 @@
+"""Write website files, only touching the ones whose content changed.
+
+A manifest of content hashes for every file written is kept in the website
+directory. Output is rendered into memory (or streamed into a temp file),
+hashed, and compared with the manifest; unchanged files are left alone and
+changed files are replaced atomically with a rename, so rsync, CDN
+invalidation and HTTP caches only see real changes.
+
+Optionally, gzip (and brotli, if the brotli module is installed) copies of
+changed files are written alongside them for nginx's gzip_static and
+brotli_static.
+"""
+
+import io
+import os
+import re
+import gzip
+import json
+import hashlib
+import tempfile
+import contextlib
+import multiprocessing
+import multiprocessing.pool
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # pylint: disable=invalid-name
+
+MANIFEST = '.manifest.json'
+
+# The "Page generated" footer line changes on every build, so it's ignored
+# when deciding whether a page changed.
+GENERATED_PATTERN = re.compile(r'Page generated .*')
+
+
+def content_hash(data: str) -> str:
+    """Return the hash used to detect changes to a file's content."""
+    data = GENERATED_PATTERN.sub('', data)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def compressed_paths(path: str) -> List[str]:
+    """Return the paths of the precompressed copies of path."""
+    paths = [path + '.gz']
+    if brotli is not None:
+        paths.append(path + '.br')
+    return paths
+
+
+def _write_bytes(path: str, data: bytes) -> None:
+    """Atomically write data to path."""
+    directory, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.%s.' % name)
+    os.chmod(tmp, 0o644)
+    with open(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def compress_file(path: str) -> None:
+    """Write gzip (and brotli) compressed copies of a file.
+
+    The gzip header has no timestamp, so the output is byte-stable.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    buf = io.BytesIO()
+    with gzip.GzipFile(
+            filename='', mode='wb', compresslevel=9, fileobj=buf,
+            mtime=0) as gz:
+        gz.write(data)
+    _write_bytes(path + '.gz', buf.getvalue())
+    if brotli is not None:
+        _write_bytes(path + '.br', brotli.compress(data))
+
+
+class _HashingFile:
+    """Wrap a text file, hashing everything written to it."""
+
+    def __init__(self, f: IO[str]) -> None:
+        self._f = f
+        self._hash = hashlib.sha1()
+
+    def write(self, data: str) -> int:
+        self._hash.update(data.encode('utf8'))
+        return self._f.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class SiteWriter:
+    """Write files under root, skipping unchanged ones.
+
+    Usage:
+        writer = SiteWriter('website')
+        writer.write('index.html', data)
+        with writer.open('api/1/player/wins/foo') as f:
+            f.write(...)
+        writer.save()
+
+    Parameters:
+        compress: also write compressed copies of changed files, see
+            compress_file
+        workers: if more than 1, compress in a pool of this many processes
+    """
+
+    def __init__(self, root: str, compress: bool=False,
+                 workers: int=1) -> None:
+        self.root = root
+        self.compress = compress
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+        self._pool = None  # type: Optional[multiprocessing.pool.Pool]
+        self._pending = []  # type: list
+        if compress and workers > 1:
+            self._pool = multiprocessing.get_context('spawn').Pool(workers)
+        try:
+            with open(os.path.join(root, MANIFEST), encoding='utf8') as f:
+                self.manifest = json.load(f)  # type: Dict[str, str]
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def _is_unchanged(self, path: str, digest: str) -> bool:
+        if self.manifest.get(path) != digest:
+            return False
+        full_path = os.path.join(self.root, path)
+        paths = [full_path]
+        if self.compress:
+            paths += compressed_paths(full_path)
+        return all(os.path.exists(p) for p in paths)
+
+    def _compress(self, full_path: str) -> None:
+        """Compress a file, in the pool if there is one."""
+        if self._pool is not None:
+            self._pending.append(
+                self._pool.apply_async(compress_file, (full_path, )))
+        else:
+            compress_file(full_path)
+
+    def _tempfile(self, path: str) -> Tuple[IO[str], str]:
+        """Return (open file, its path) for a temp file next to path."""
+        directory, name = os.path.split(os.path.join(self.root, path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.%s.' % name)
+        os.chmod(tmp, 0o644)
+        return open(fd, 'w', encoding='utf8'), tmp
+
+    def _replace(self, tmp: str, path: str, digest: str) -> None:
+        """Move a finished temp file into place and record its hash."""
+        full_path = os.path.join(self.root, path)
+        os.replace(tmp, full_path)
+        if self.compress:
+            self._compress(full_path)
+        else:
+            # Don't leave stale copies from an earlier compressed build
+            for p in (full_path + '.gz', full_path + '.br'):
+                if os.path.exists(p):
+                    os.unlink(p)
+        self.manifest[path] = digest
+        self.written += 1
+
+    def write(self, path: str, data: str) -> bool:
+        """Write data to path (relative to root) if it changed.
+
+        Returns True if the file was written.
+        """
+        digest = content_hash(data)
+        if self._is_unchanged(path, digest):
+            self.unchanged += 1
+            return False
+        f, tmp = self._tempfile(path)
+        with f:
+            f.write(data)
+        self._replace(tmp, path, digest)
+        return True
+
+    def write_bytes(self, path: str, data: bytes) -> bool:
+        """Write binary data (eg an image) to path if it changed.
+
+        Binary files aren't compressed. Returns True if the file was written.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        full_path = os.path.join(self.root, path)
+        if self.manifest.get(path) == digest and os.path.exists(full_path):
+            self.unchanged += 1
+            return False
+        _write_bytes(full_path, data)
+        self.manifest[path] = digest
+        self.written += 1
+        return True
+
+    def remove(self, path: str) -> bool:
+        """Remove a file and its compressed copies, and forget its hash.
+
+        Returns True if the file existed.
+        """
+        full_path = os.path.join(self.root, path)
+        existed = os.path.exists(full_path)
+        # Check both copies, as brotli may not be installed on this build
+        for p in (full_path, full_path + '.gz', full_path + '.br'):
+            if os.path.exists(p):
+                os.unlink(p)
+        self.manifest.pop(path, None)
+        if existed:
+            self.removed += 1
+        return existed
+
+    @contextlib.contextmanager
+    def open(self, path: str) -> Iterator[_HashingFile]:
+        """Stream a file's content, writing it to path if it changed.
+
+        Content written this way is hashed as-is, without ignoring
+        GENERATED_PATTERN.
+        """
+        f, tmp = self._tempfile(path)
+        try:
+            with f:
+                hashing = _HashingFile(f)
+                yield hashing
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        digest = hashing.hexdigest()
+        if self._is_unchanged(path, digest):
+            os.unlink(tmp)
+            self.unchanged += 1
+        else:
+            self._replace(tmp, path, digest)
+
+    def save(self) -> None:
+        """Wait for any compression to finish, then write the manifest."""
+        if self._pool is not None:
+            for result in self._pending:
+                result.get()
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pending = []
+        f, tmp = self._tempfile(MANIFEST)
+        with f:
+            json.dump(self.manifest, f, sort_keys=True)
+        os.replace(tmp, os.path.join(self.root, MANIFEST))
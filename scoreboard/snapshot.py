@@ -0,0 +1,206 @@
+"""Export a columnar snapshot of the games table for analytics.
+
+Each column is a flat binary file of fixed-width integers which can be
+memory-mapped with NumPy, plus a manifest.json recording the row count,
+column dtypes, the dimension tables needed to decode ids, and the (end, gid)
+keyset of the last exported game. Refreshing the snapshot only appends the
+games which ended after that keyset.
+"""
+
+import os
+import json
+import time
+import calendar
+import datetime
+from typing import Optional, Sequence
+
+import numpy
+import sqlalchemy.orm  # for sqlalchemy.orm.session.Session type hints
+
+from . import model
+from . import orm
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+# (column name, dtype, Game column)
+COLUMNS = (
+    ('species_id', 'int16', orm.Game.species_id),
+    ('background_id', 'int16', orm.Game.background_id),
+    ('god_id', 'int16', orm.Game.god_id),
+    ('version_id', 'int16', orm.Game.version_id),
+    ('ktyp_id', 'int16', orm.Game.ktyp_id),
+    ('place_id', 'int16', orm.Game.place_id),
+    ('player_id', 'int32', orm.Game.player_id),
+    ('score', 'int64', orm.Game.score),
+    ('turn', 'int32', orm.Game.turn),
+    ('dur', 'int32', orm.Game.dur),
+    ('start', 'int64', orm.Game.start),
+    ('end', 'int64', orm.Game.end), )
+
+EPOCH_COLUMNS = ('start', 'end')
+
+
+def _epoch(d: datetime.datetime) -> int:
+    """Convert a (naive, UTC) datetime to a unix timestamp."""
+    return calendar.timegm(d.utctimetuple())
+
+
+def _column_path(path: str, name: str) -> str:
+    return os.path.join(path, '%s.bin' % name)
+
+
+def read_manifest(path: str) -> Optional[dict]:
+    """Return a snapshot's manifest, or None if there's no valid snapshot."""
+    try:
+        with open(os.path.join(path, MANIFEST), encoding='utf8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != FORMAT_VERSION:
+        return None
+    return manifest
+
+
+def _write_manifest(path: str, manifest: dict) -> None:
+    """Atomically replace the manifest."""
+    tmp = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp, 'w', encoding='utf8') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+def _dimensions(s: sqlalchemy.orm.session.Session) -> dict:
+    """Return {dimension: {id: label}} for the int-coded columns."""
+    places = s.query(orm.Place.id, orm.Place.level, orm.Branch.short,
+                     orm.Branch.multilevel).join(orm.Place.branch)
+    return {
+        'species': {i: short
+                    for i, short in s.query(orm.Species.id, orm.Species.short)},
+        'background': {
+            i: short
+            for i, short in s.query(orm.Background.id, orm.Background.short)
+        },
+        'god': {i: name
+                for i, name in s.query(orm.God.id, orm.God.name)},
+        'version': {i: v
+                    for i, v in s.query(orm.Version.id, orm.Version.v)},
+        'ktyp': {i: name
+                 for i, name in s.query(orm.Ktyp.id, orm.Ktyp.name)},
+        'place': {
+            i: '%s:%s' % (br, lvl) if multilevel else br
+            for i, lvl, br, multilevel in places
+        },
+    }
+
+
+def _is_consistent(s: sqlalchemy.orm.session.Session,
+                   path: str,
+                   manifest: dict) -> bool:
+    """Check a snapshot can be appended to.
+
+    Games imported late can end before the snapshot's last keyset, and
+    would be skipped by an append. Detect this by comparing the number of
+    games up to the keyset with the number of exported rows.
+    """
+    if manifest['last'] is None:
+        return manifest['rows'] == 0
+    end = datetime.datetime.utcfromtimestamp(manifest['last'][0])
+    gid = manifest['last'][1]
+    n = s.query(orm.Game).filter(orm.Game.end <= end,
+                                 sqlalchemy.or_(orm.Game.end < end,
+                                                orm.Game.gid <= gid)).count()
+    if n != manifest['rows']:
+        return False
+    for name, dtype, _ in COLUMNS:
+        try:
+            size = os.path.getsize(_column_path(path, name))
+        except OSError:
+            return False
+        if size < manifest['rows'] * numpy.dtype(dtype).itemsize:
+            return False
+    return True
+
+
+def export_snapshot(path: str, batch_size: int=50000) -> None:
+    """Create or incrementally refresh the games snapshot in path."""
+    print("Exporting games snapshot to %s" % path)
+    start = time.time()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    s = orm.get_session(readonly=True)
+
+    manifest = read_manifest(path)
+    if manifest is not None and not _is_consistent(s, path, manifest):
+        print("Snapshot is out of date, rebuilding")
+        manifest = None
+    if manifest is None:
+        manifest = {
+            'version': FORMAT_VERSION,
+            'rows': 0,
+            'last': None,
+            'columns': {name: dtype
+                        for name, dtype, _ in COLUMNS},
+        }
+
+    # Drop anything past the last complete export (eg after a crash)
+    rows = manifest['rows']
+    for name, dtype, _ in COLUMNS:
+        with open(_column_path(path, name), 'ab') as f:
+            f.truncate(rows * numpy.dtype(dtype).itemsize)
+
+    after = None
+    if manifest['last'] is not None:
+        after = (datetime.datetime.utcfromtimestamp(manifest['last'][0]),
+                 manifest['last'][1])
+    columns = [orm.Game.gid] + [col for _, _, col in COLUMNS]
+    files = {
+        name: open(_column_path(path, name), 'ab')
+        for name, _, _ in COLUMNS
+    }
+    new = 0
+    try:
+        for batch in model.iter_game_batches(
+                s,
+                reverse_order=True,
+                batch_size=batch_size,
+                after=after,
+                columns=columns):
+            for i, (name, dtype, _) in enumerate(COLUMNS, start=1):
+                values = [row[i] for row in batch]  # type: Sequence
+                if name in EPOCH_COLUMNS:
+                    values = [_epoch(v) for v in values]
+                files[name].write(numpy.array(values, dtype=dtype).tobytes())
+            new += len(batch)
+            manifest['last'] = [_epoch(batch[-1].end), batch[-1].gid]
+    finally:
+        for f in files.values():
+            f.close()
+
+    manifest['rows'] = rows + new
+    manifest['dimensions'] = _dimensions(s)
+    _write_manifest(path, manifest)
+    print("Exported %s new games (%s total) in %s secs" %
+          (new, manifest['rows'], round(time.time() - start, 2)))
+
+
+def load_columns(path: str) -> dict:
+    """Memory-map a snapshot's columns.
+
+    Returns a dict with the manifest under 'manifest' and a read-only
+    numpy array for each column.
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise ValueError("No games snapshot in %s" % path)
+    out = {'manifest': manifest}
+    for name, dtype in manifest['columns'].items():
+        if manifest['rows']:
+            out[name] = numpy.memmap(
+                _column_path(path, name),
+                dtype=dtype,
+                mode='r',
+                shape=(manifest['rows'], ))
+        else:
+            out[name] = numpy.zeros(0, dtype=dtype)
+    return out
@@ -0,0 +1,215 @@
+"""Profile the SQL statements issued by the scoreboard.
+
+Every statement is attributed to the innermost calling function in one of
+CALL_SITE_MODULES, so N+1 query patterns (eg lazy loads while rendering a
+table) show up as a call site with a huge statement count.
+"""
+
+import re
+import sys
+import math
+import time
+import collections
+import contextlib
+from typing import Any, Dict, Iterator, List
+
+import sqlalchemy
+import sqlalchemy.engine
+import sqlalchemy.event
+
+CALL_SITE_MODULES = ('scoreboard.model', 'scoreboard.webutils',
+                     'scoreboard.write_website', 'scoreboard.scoring',
+                     'scoreboard.log_import')
+
+# Statement normalisation: collapse IN lists, numbers and whitespace
+_IN_LIST_PATTERN = re.compile(r'IN \((?:[^()]*?,\s*)+[^()]*?\)', re.I)
+_NUMBER_PATTERN = re.compile(r'\b\d+\b')
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalise_statement(statement: str) -> str:
+    """Reduce a statement to a form that groups equivalent queries."""
+    statement = _WHITESPACE_PATTERN.sub(' ', statement).strip()
+    statement = _IN_LIST_PATTERN.sub('IN (...)', statement)
+    return _NUMBER_PATTERN.sub('N', statement)
+
+
+def call_site() -> str:
+    """Return 'module.function' for the innermost scoreboard caller."""
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module in CALL_SITE_MODULES:
+            return '%s.%s' % (module.split('.')[-1], frame.f_code.co_name)
+        frame = frame.f_back
+    return '<other>'
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Return the pct percentile (nearest rank) of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class _Stats:  # pylint: disable=too-few-public-methods
+    """Timings and row counts for a group of statements."""
+
+    def __init__(self) -> None:
+        self.times = []  # type: List[float]
+        self.rows = 0
+
+    @property
+    def count(self) -> int:
+        """Number of statements."""
+        return len(self.times)
+
+    @property
+    def total(self) -> float:
+        """Total execution time in seconds."""
+        return sum(self.times)
+
+
+class _RowCountingCursor:
+    """Proxy a DBAPI cursor, counting the rows fetched through it."""
+
+    def __init__(self, cursor: Any, stats: List[_Stats]) -> None:
+        self._cursor = cursor
+        self._stats = stats
+
+    def _count(self, n: int) -> None:
+        for stats in self._stats:
+            stats.rows += n
+
+    def fetchone(self) -> Any:
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args: Any) -> list:
+        rows = self._cursor.fetchmany(*args)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self) -> list:
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self) -> Iterator:
+        for row in self._cursor:
+            self._count(1)
+            yield row
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+
+class SQLProfiler:
+    """Collect per-call-site and per-statement SQL timings.
+
+    Usage:
+        profiler = SQLProfiler()
+        profiler.install()
+        with profiler.phase('scoring'):
+            ...
+        print(profiler.report())
+    """
+
+    def __init__(self, top: int=10) -> None:
+        self.top = top
+        self.current_phase = 'setup'
+        self.phases = collections.OrderedDict()  # type: Dict[str, _Stats]
+        self.sites = collections.defaultdict(_Stats)  # type: Dict[str, _Stats]
+        self.statements = collections.defaultdict(
+            _Stats)  # type: Dict[str, _Stats]
+
+    def install(self) -> None:
+        """Start profiling statements on every engine."""
+        sqlalchemy.event.listen(sqlalchemy.engine.Engine,
+                                'before_cursor_execute',
+                                self._before_cursor_execute)
+        sqlalchemy.event.listen(sqlalchemy.engine.Engine,
+                                'after_cursor_execute',
+                                self._after_cursor_execute)
+
+    def uninstall(self) -> None:
+        """Stop profiling."""
+        sqlalchemy.event.remove(sqlalchemy.engine.Engine,
+                                'before_cursor_execute',
+                                self._before_cursor_execute)
+        sqlalchemy.event.remove(sqlalchemy.engine.Engine,
+                                'after_cursor_execute',
+                                self._after_cursor_execute)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Attribute statements issued inside the block to phase name."""
+        previous = self.current_phase
+        self.current_phase = name
+        try:
+            yield
+        finally:
+            self.current_phase = previous
+
+    def _before_cursor_execute(self, conn: Any, cursor: Any, statement: str,
+                               parameters: Any, context: Any,
+                               executemany: bool) -> None:
+        conn.info.setdefault('sqlprofile_start', []).append(
+            time.perf_counter())
+
+    def _after_cursor_execute(self, conn: Any, cursor: Any, statement: str,
+                              parameters: Any, context: Any,
+                              executemany: bool) -> None:
+        elapsed = time.perf_counter() - conn.info['sqlprofile_start'].pop()
+        phase = self.phases.setdefault(self.current_phase, _Stats())
+        site = self.sites[call_site()]
+        stmt = self.statements[normalise_statement(statement)]
+        for stats in (phase, site, stmt):
+            stats.times.append(elapsed)
+        if cursor.description is None:
+            if cursor.rowcount > 0:
+                for stats in (phase, site, stmt):
+                    stats.rows += cursor.rowcount
+        elif context is not None:
+            # Rows are counted as the result is fetched
+            context.cursor = _RowCountingCursor(cursor, [phase, site, stmt])
+
+    def report(self) -> str:
+        """Return a plain text report of everything profiled so far."""
+        lines = []
+        row_fmt = '{name:<45} {count:>8} {total:>10.1f} {mean:>8.2f} ' \
+                  '{p95:>8.2f} {rows:>10}'
+        header = '{:<45} {:>8} {:>10} {:>8} {:>8} {:>10}'.format(
+            '', 'stmts', 'total ms', 'mean ms', 'p95 ms', 'rows')
+
+        def fmt(name: str, stats: _Stats) -> str:
+            return row_fmt.format(
+                name=name[:45],
+                count=stats.count,
+                total=stats.total * 1000,
+                mean=stats.total / stats.count * 1000 if stats.count else 0,
+                p95=percentile(stats.times, 95) * 1000,
+                rows=stats.rows)
+
+        lines.append('SQL profile by phase')
+        lines.append(header)
+        for name, stats in self.phases.items():
+            lines.append(fmt(name, stats))
+        lines.append('')
+        lines.append('SQL profile by call site')
+        lines.append(header)
+        for name, stats in sorted(
+                self.sites.items(), key=lambda i: i[1].total, reverse=True):
+            lines.append(fmt(name, stats))
+        lines.append('')
+        lines.append('Top %s statements by total time' % self.top)
+        for stmt, stats in sorted(
+                self.statements.items(), key=lambda i: i[1].total,
+                reverse=True)[:self.top]:
+            lines.append(fmt('', stats))
+            lines.append('    ' + stmt)
+        return '\n'.join(lines)
+
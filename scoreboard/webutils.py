@@ -1,8 +1,13 @@
 """Utility functions for website generation."""
 
-from typing import Iterable, Sequence, Optional, Callable
+from typing import Dict, Iterable, Sequence, Optional, Callable
+import os
+import time
+import hashlib
+import tempfile
+import functools
+import collections
 import datetime  # for typing
-import uuid
 
 import jinja2
 
@@ -82,6 +87,192 @@ def link_player(player_name: str, player_url: str, urlbase: str) -> str:
         base=urlbase, player_url=player_url, player_name=player_name)
 
 
+def _table_id(*parts: str) -> str:
+    """Return a table id derived from the table's content.
+
+    Unlike a random id this keeps rendered pages byte-stable between builds.
+    """
+    digest = hashlib.sha1(''.join(parts).encode('utf8')).hexdigest()
+    return 'table-%s' % digest[:12]
+
+
+# Game table row cells (everything after the rank cell). _row_layout blanks
+# out the columns a table variant doesn't show.
+TROW_CELLS = """{prefix_col}
+      {player_row}
+      {score}
+      <td><abbr data-toggle="tooltip" title="{full_character}">{character}</abbr></td>
+      <td>{god}</td>
+      {place}
+      {end}
+      {runes}
+      <td class="text-xs-right">{turns}</td>
+      <td class="text-xs-right">{duration}</td>
+      <td class="text-xs-right">{date}</td>
+      <td>{version}</td>
+      <td>{morgue}</td>
+    </tr>"""
+
+# Rendered row cells, keyed by (gid, table variant). The same games appear
+# in many tables (eg top scores on the index, highscores and player pages),
+# so each is rendered once per website build. Oldest entries are dropped
+# past ROW_CACHE_SIZE.
+ROW_CACHE_SIZE = 50000
+_row_cache = collections.OrderedDict()  # type: Dict[tuple, str]
+
+
+def clear_row_cache() -> None:
+    """Forget all rendered game table rows, eg before a website build."""
+    _row_cache.clear()
+
+
+# Rendered tables, keyed by a hash of the table variant and the games (or
+# streaks) in it, see _cached_table. Every table is kept in memory for the
+# build, and the shared boards (index, highscores, streaks) are also saved
+# in the fragment cache dir so later runs can reuse them.
+FRAGMENT_CACHE_SIZE = 1000
+_fragment_cache = collections.OrderedDict()  # type: Dict[str, str]
+_fragment_cache_dir = None  # type: Optional[str]
+
+
+@functools.lru_cache(maxsize=None)
+def _code_hash() -> str:
+    """Hash the modules which tables are rendered by.
+
+    Cached tables are invalidated whenever these change.
+    """
+    h = hashlib.sha1()
+    for module in (__file__, modelutils.__file__, const.__file__):
+        with open(module, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def setup_fragment_cache(path: Optional[str]) -> None:
+    """Forget in-memory tables and save tables in path (None to disable)."""
+    global _fragment_cache_dir  # pylint: disable=global-statement
+    _fragment_cache.clear()
+    _fragment_cache_dir = path
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+
+
+def prune_fragment_cache(max_age: int) -> int:
+    """Delete saved tables which haven't been used for max_age days.
+
+    Returns the number of tables deleted.
+    """
+    if _fragment_cache_dir is None:
+        return 0
+    cutoff = time.time() - max_age * 86400
+    deleted = 0
+    for subdir in os.scandir(_fragment_cache_dir):
+        if not subdir.is_dir():
+            continue
+        for entry in os.scandir(subdir.path):
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                deleted += 1
+    return deleted
+
+
+def _fragment_path(key: str) -> str:
+    return os.path.join(_fragment_cache_dir, key[:2], key + '.html')
+
+
+def _cached_table(kind: str,
+                  variant: tuple,
+                  rows: Sequence,
+                  render: Callable[[], str],
+                  persist: bool=False) -> str:
+    """Return a rendered table, from the fragment cache if possible.
+
+    Parameters:
+        kind: the table function, eg 'games'
+        variant: every option the output depends on
+        rows: ids of the table's rows, eg game gids
+        render: renders the table if it isn't cached
+        persist: also save the table in the fragment cache dir. Only worth
+            it for tables which are likely to be unchanged next run, not
+            eg per-player tables.
+    """
+    key = hashlib.sha1(
+        repr((_code_hash(), kind, variant, rows)).encode('utf8')).hexdigest()
+    html = _fragment_cache.get(key)
+    if html is not None:
+        return html
+    persist = persist and _fragment_cache_dir is not None
+    if persist:
+        path = _fragment_path(key)
+        try:
+            with open(path, encoding='utf8') as f:
+                html = f.read()
+            # Keep it from being pruned
+            os.utime(path)
+        except OSError:
+            pass
+    if html is None:
+        html = render()
+        if persist:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with open(fd, 'w', encoding='utf8') as f:
+                f.write(html)
+            os.replace(tmp, path)
+    if len(_fragment_cache) >= FRAGMENT_CACHE_SIZE:
+        _fragment_cache.popitem(last=False)
+    _fragment_cache[key] = html
+    return html
+
+
+@functools.lru_cache(maxsize=None)
+def _row_layout(prefix_col: bool, show_player: bool,
+                winning_games: bool) -> str:
+    """Return the row cells format string for a game table variant."""
+    fields = {
+        name: '{%s}' % name
+        for name in ('full_character', 'character', 'god', 'turns',
+                     'duration', 'date', 'version', 'morgue')
+    }
+    return TROW_CELLS.format(
+        prefix_col='<td>{prefix_col}</td>' if prefix_col else '',
+        player_row='<td>{player_row}</td>' if show_player else '',
+        score='<td class="text-xs-right">{score}</td>'
+        if winning_games else '',
+        place='' if winning_games else '<td>{place}</td>',
+        end='' if winning_games else '<td>{end}</td>',
+        runes='<td class="text-xs-right">{runes}</td>'
+        if winning_games else '',
+        **fields)
+
+
+def _row_cells(game: orm.Game, layout: str, prefix_col: Optional[Callable],
+               show_player: bool, winning_games: bool, urlbase: str) -> str:
+    """Render a game's row cells, computing only the columns in layout."""
+    fields = {
+        'character': game.char,
+        'full_character': game.species.name + ' ' + game.background.name,
+        'god': game.god.name,
+        'turns': prettyint(game.turn),
+        'duration': prettydur(game.dur),
+        'date': prettydate(game.end),
+        'version': game.version.v,
+        'morgue': morgue_link(game),
+    }
+    if prefix_col:
+        fields['prefix_col'] = prefix_col(game)
+    if show_player:
+        fields['player_row'] = link_player(game.player.name,
+                                           game.player.url_name, urlbase)
+    if winning_games:
+        fields['score'] = prettyint(game.score)
+        fields['runes'] = game.runes
+    else:
+        fields['place'] = game.place.as_string
+        fields['end'] = game.pretty_tmsg
+    return layout.format(**fields)
+
+
 def _games_to_table(env: jinja2.environment.Environment,
                     games: Iterable[orm.Game],
                     *,
@@ -92,13 +283,49 @@ def _games_to_table(env: jinja2.environment.Environment,
                     show_ranks: bool=False,
                     winning_games: bool=False,
                     skip_header: bool=False,
-                    datatables: bool=False) -> str:
+                    datatables: bool=False,
+                    persist: bool=False) -> str:
+    """Convert a list of games into a standard table, see _render_games_table.
+
+    Tables are cached by their games and options, see _cached_table.
+    """
+    games = list(games)
+    variant = (prefix_col_title, show_player, show_number, show_ranks,
+               winning_games, skip_header, datatables, env.globals['urlbase'])
+    return _cached_table(
+        'games', variant, [g.gid for g in games], lambda: _render_games_table(
+            env,
+            games,
+            prefix_col=prefix_col,
+            prefix_col_title=prefix_col_title,
+            show_player=show_player,
+            show_number=show_number,
+            show_ranks=show_ranks,
+            winning_games=winning_games,
+            skip_header=skip_header,
+            datatables=datatables),
+        persist=persist)
+
+
+def _render_games_table(env: jinja2.environment.Environment,
+                        games: Iterable[orm.Game],
+                        *,
+                        prefix_col: Optional[Callable]=None,
+                        prefix_col_title: Optional[str]=None,
+                        show_player: bool=False,
+                        show_number: int=0,
+                        show_ranks: bool=False,
+                        winning_games: bool=False,
+                        skip_header: bool=False,
+                        datatables: bool=False) -> str:
     """Jinja filter to convert a list of games into a standard table.
 
     Parameters:
         env: Environment -- passed in automatically
         prefix_col (func): Function to return prefix column's value. Passed each game.
-        prefix_col_title (str): Title for the prefix_col column
+        prefix_col_title (str): Title for the prefix_col column. Rendered rows
+                                are cached by title, so each prefix_col
+                                function needs its own title.
         show_player (bool): Show the player name column
         show_number (int): If greater than zero, the initial number of rows to display
         show_ranks (bool): Show position ranks
@@ -109,6 +336,10 @@ def _games_to_table(env: jinja2.environment.Environment,
     Returns: (string) '<table>contents</table>'.
     """
 
+    urlbase = env.globals['urlbase']
+    layout = _row_layout(prefix_col is not None, show_player, winning_games)
+    variant = (prefix_col_title, show_player, winning_games, urlbase)
+
     def format_trow(game: orm.Game, index: int,
                     hidden_game: bool=False) -> str:
         """Convert a game to a table row."""
@@ -118,30 +349,18 @@ def _games_to_table(env: jinja2.environment.Environment,
         if hidden_game:
             classes += "hidden-game "
 
-        return trow.format(
-            rank='' if not show_ranks else
-            """<td class="text-xs-right">%d</td>""" % (index + 1),
-            tr_class=classes,
-            prefix_col=''
-            if not prefix_col else "<td>%s</td>" % prefix_col(game),
-            player_row='' if not show_player else
-            "<td>%s</td>" % link_player(game.player.name, game.player.url_name,
-                                        env.globals['urlbase']),
-            score='<td class="text-xs-right">{}</td>'.format(
-                prettyint(game.score)) if winning_games else '',
-            character=game.char,
-            full_character=game.species.name + ' ' + game.background.name,
-            god=game.god.name,
-            place=""
-            if winning_games else "<td>%s</td>" % game.place.as_string,
-            end="" if winning_games else "<td>%s</td>" % game.pretty_tmsg,
-            runes='<td class="text-xs-right">{}</td>'.format(game.runes)
-            if winning_games else '',
-            turns=prettyint(game.turn),
-            duration=prettydur(game.dur),
-            date=prettydate(game.end),
-            version=game.version.v,
-            morgue=morgue_link(game))
+        key = (game.gid, variant)
+        cells = _row_cache.get(key)
+        if cells is None:
+            cells = _row_cells(game, layout, prefix_col, show_player,
+                               winning_games, urlbase)
+            if len(_row_cache) >= ROW_CACHE_SIZE:
+                _row_cache.popitem(last=False)
+            _row_cache[key] = cells
+
+        return '<tr class="%s">\n      %s\n      %s' % (
+            classes, '' if not show_ranks else
+            """<td class="text-xs-right">%d</td>""" % (index + 1), cells)
 
     t = """<table id="{id}" class="{classes}">
           <thead>
@@ -214,23 +433,6 @@ def _games_to_table(env: jinja2.environment.Environment,
         end='' if winning_games else '<th>End</th>',
         runes='<th class="text-xs-right">Runes</th>' if winning_games else '')
 
-    trow = """<tr class="{tr_class}">
-      {rank}
-      {prefix_col}
-      {player_row}
-      {score}
-      <td><abbr data-toggle="tooltip" title="{full_character}">{character}</abbr></td>
-      <td>{god}</td>
-      {place}
-      {end}
-      {runes}
-      <td class="text-xs-right">{turns}</td>
-      <td class="text-xs-right">{duration}</td>
-      <td class="text-xs-right">{date}</td>
-      <td>{version}</td>
-      <td>{morgue}</td>
-    </tr>"""
-
     tbody = "\n".join(
         format_trow(
             game=game,
@@ -238,17 +440,20 @@ def _games_to_table(env: jinja2.environment.Environment,
             hidden_game=(index >= show_number if show_number > 0 else False))
         for index, game in enumerate(games))
 
+    if skip_header:
+        thead = ''
     return t.format(
-        id=uuid.uuid4(),
+        id=_table_id(thead, tbody),
         classes=const.TABLE_CLASSES,
-        thead=thead if not skip_header else '',
+        thead=thead,
         tbody=tbody)
 
 
 def streakstotable(streaks: Sequence[orm.Streak],
                    show_player: bool=True,
                    show_loss: bool=True,
-                   limit: Optional[int]=None) -> str:
+                   limit: Optional[int]=None,
+                   persist: bool=False) -> str:
     """Jinja filter to convert a list of streaks into a standard table.
 
     Parameters:
@@ -256,6 +461,8 @@ def streakstotable(streaks: Sequence[orm.Streak],
         show_player (bool): Show the player name column.
         show_loss (bool): Show the losing game column.
         limit (int): The table won't display more games than this.
+        persist (bool): Save the table in the fragment cache, see
+            _cached_table.
 
     Returns: (string) '<table>contents</table>'.
     """
@@ -316,11 +523,16 @@ def streakstotable(streaks: Sequence[orm.Streak],
     if limit:
         streaks = streaks[:limit]
 
-    return t.format(
-        classes=const.TABLE_CLASSES,
-        thead=thead,
-        tbody="\n".join(
-            format_trow(streak, show_player, show_loss) for streak in streaks))
+    return _cached_table(
+        'streaks', (show_player, show_loss),
+        [(streak.id, [g.gid for g in streak.games]) for streak in streaks],
+        lambda: t.format(
+            classes=const.TABLE_CLASSES,
+            thead=thead,
+            tbody="\n".join(
+                format_trow(streak, show_player, show_loss)
+                for streak in streaks)),
+        persist=persist)
 
 
 def mosthighscorestotable(highscores: Iterable) -> str:
@@ -360,38 +572,44 @@ def mosthighscorestotable(highscores: Iterable) -> str:
 
 
 def recordsformatted(records: dict) -> str:
-    """Show any records a player holds."""
-    result = """{race}
-                {role}
+    """Show any records a player holds.
+
+    records is a player's entry from model.get_gobal_records.
+    """
+    result = """{species}
+                {background}
                 {god}
                 {combo}"""
 
-    race = ''
-    role = ''
+    species = ''
+    background = ''
     god = ''
     combo = ''
 
-    if records['race']:
-        race = "<p><strong>Species (%s):</strong> %s</p>" % (
-            len(records['race']), ', '.join(
-                [morgue_link(game, game.rc) for game in records['race']]))
+    if records.get('species'):
+        species = "<p><strong>Species (%s):</strong> %s</p>" % (
+            len(records['species']), ', '.join(
+                [morgue_link(game, game.species.short)
+                 for game in records['species']]))
 
-    if records['role']:
-        role = "<p><strong>Backgrounds (%s):</strong> %s</p>" % (
-            len(records['role']), ', '.join(
-                [morgue_link(game, game.bg) for game in records['role']]))
+    if records.get('background'):
+        background = "<p><strong>Backgrounds (%s):</strong> %s</p>" % (
+            len(records['background']), ', '.join(
+                [morgue_link(game, game.background.short)
+                 for game in records['background']]))
 
-    if records['god']:
+    if records.get('god'):
         god = "<p><strong>Gods (%s):</strong> %s</p>" % (
             len(records['god']), ', '.join(
-                [morgue_link(game, game.god) for game in records['god']]))
+                [morgue_link(game, game.god.name) for game in records['god']]))
 
-    if records['combo']:
+    if records.get('combo'):
         combo = "<p><strong>Combos (%s):</strong> %s</p>" % (
             len(records['combo']), ', '.join(
                 [morgue_link(game, game.char) for game in records['combo']]))
 
-    return result.format(race=race, role=role, god=god, combo=combo)
+    return result.format(
+        species=species, background=background, god=god, combo=combo)
 
 
 def morgue_link(game: orm.Game, text: str="Morgue") -> str:
@@ -443,7 +661,8 @@ def generic_highscores_to_table(env: jinja2.environment.Environment,
                                 show_player: bool=True,
                                 show_number: int=0,
                                 show_ranks: bool=True,
-                                datatables: bool=False) -> str:
+                                datatables: bool=False,
+                                persist: bool=False) -> str:
     """Convert list of winning games into a HTML table."""
     return _games_to_table(
         env,
@@ -452,12 +671,14 @@ def generic_highscores_to_table(env: jinja2.environment.Environment,
         show_number=show_number,
         show_ranks=show_ranks,
         winning_games=True,
-        datatables=datatables)
+        datatables=datatables,
+        persist=persist)
 
 
 @jinja2.environmentfilter
 def species_highscores_to_table(env: jinja2.environment.Environment,
-                                data: Iterable) -> str:
+                                data: Iterable,
+                                persist: bool=False) -> str:
     """Convert list of games for each species into a HTML table."""
     return _games_to_table(
         env,
@@ -465,12 +686,14 @@ def species_highscores_to_table(env: jinja2.environment.Environment,
         show_player=True,
         prefix_col=lambda g: g.species.name,
         prefix_col_title='Species',
-        winning_games=True)
+        winning_games=True,
+        persist=persist)
 
 
 @jinja2.environmentfilter
 def background_highscores_to_table(env: jinja2.environment.Environment,
-                                   data: Iterable) -> str:
+                                   data: Iterable,
+                                   persist: bool=False) -> str:
     """Convert list of games for each background into a HTML table."""
     return _games_to_table(
         env,
@@ -478,4 +701,5 @@ def background_highscores_to_table(env: jinja2.environment.Environment,
         show_player=True,
         prefix_col=lambda g: g.background.name,
         prefix_col_title='Background',
-        winning_games=True)
+        winning_games=True,
+        persist=persist)
@@ -4,54 +4,73 @@ import os
 import json
 import time
 import datetime
-import subprocess
 import collections
-import random
-import shutil
-import sys
+import multiprocessing
 
-from typing import Iterable, Optional, Sequence
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, \
+    Sequence, Tuple
 
-import jsmin
 import jinja2
 import sqlalchemy.orm  # for sqlalchemy.orm.session.Session type hints
 
 from . import model
+from . import assets
 from . import webutils
+from . import sitewriter
+from . import playerindex
+from . import playerapi
+from . import schedule
+from . import buildreport
 from . import orm
 from . import constants as const
 
 WEBSITE_DIR = 'website'
-
-
-def rsync_replacement(src: str, dst: str) -> None:
-    """Poor replacement for rsync on win32.
-
-    Needed because shutil.copytree can't handle already existing dest dir.
+# Player pages are rendered in groups of this many players, with one batch
+# of queries per group (see model.player_page_data)
+PLAYER_PAGE_GROUP_SIZE = 100
+# Written player pages are recorded (and removed from the dirty_pages queue)
+# in transactions of this many pages
+PLAYER_PAGE_COMMIT_SIZE = 500
+# Compiled template cache, see template_environment
+TEMPLATE_CACHE_DIR = 'template-cache'
+# Default rendered table cache, see webutils._cached_table. Tables which
+# haven't been used for FRAGMENT_MAX_AGE days are deleted.
+FRAGMENT_CACHE_DIR = 'fragment-cache'
+FRAGMENT_MAX_AGE = 30
+# Timing report of the last build, see scoreboard.buildreport
+BUILD_REPORT = 'build-report.json'
+
+
+def _write_json_list(*, writer: sitewriter.SiteWriter, path: str,
+                     items: Iterable[dict]) -> None:
+    """Write an iterable of dicts as an indented JSON list.
+
+    The output matches json.dumps(list(items), sort_keys=True, indent=2),
+    but items are encoded and written one at a time.
+    """
+    with writer.open(path) as f:
+        first = True
+        for item in items:
+            f.write('[\n  ' if first else ',\n  ')
+            first = False
+            f.write(
+                json.dumps(item, sort_keys=True, indent=2).replace(
+                    '\n', '\n  '))
+        f.write('[]' if first else '\n]')
+
+
+def template_environment() -> jinja2.environment.Environment:
+    """Create a Jinja environment with the scoreboard's templates and filters.
+
+    Compiled templates are cached in TEMPLATE_CACHE_DIR, which is shared by
+    every run and render worker. Jinja checks each cached template against
+    a checksum of its source, so edited templates are recompiled.
     """
-    if not os.path.exists(dst):
-        os.makedirs(dst)
-    for item in os.listdir(src):
-        s = os.path.join(src, item)
-        d = os.path.join(dst, item)
-        if os.path.isdir(s):
-            rsync_replacement(s, d)
-        else:
-            shutil.copy2(s, d)
-
-
-def _write_file(*, path: str, data: str) -> None:
-    """Write a file."""
-    with open(path, 'w', encoding='utf8') as f:
-        f.write(data)
-
-
-def jinja_env(
-        urlbase: Optional[str],
-        s: sqlalchemy.orm.session.Session) -> jinja2.environment.Environment:
-    """Create the Jinja template environment."""
     template_path = os.path.join(os.path.dirname(__file__), 'html_templates')
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_path))
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_path),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_DIR))
     env.filters['prettyint'] = webutils.prettyint
     env.filters['prettyhours'] = webutils.prettyhours
     env.filters['prettydur'] = webutils.prettydur
@@ -76,6 +95,31 @@ def jinja_env(
     env.filters[
         'background_highscores_to_table'] = webutils.background_highscores_to_table
 
+    return env
+
+
+def compile_templates() -> None:
+    """Compile every template into the template cache."""
+    env = template_environment()
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    print("Compiled %s templates into %s" % (len(names), TEMPLATE_CACHE_DIR))
+
+
+def jinja_env(urlbase: Optional[str],
+              s: sqlalchemy.orm.session.Session,
+              fragment_cache_dir: Optional[str]=None) \
+        -> jinja2.environment.Environment:
+    """Create the Jinja template environment for a website build.
+
+    Parameters:
+        fragment_cache_dir: save shared tables here, see
+            webutils.setup_fragment_cache. None to only cache them in memory.
+    """
+    webutils.clear_row_cache()
+    webutils.setup_fragment_cache(fragment_cache_dir)
+    env = template_environment()
     env.globals['tableclasses'] = const.TABLE_CLASSES
     env.globals['playable_species'] = model.list_species(s, playable=True)
     env.globals['playable_backgrounds'] = model.list_backgrounds(
@@ -98,6 +142,7 @@ def _mkdir(path: str) -> None:
 
 
 def setup_website_dir(env: jinja2.environment.Environment,
+                      writer: sitewriter.SiteWriter,
                       path: str,
                       all_players: Iterable) -> None:
     """Create the website dir and add static content."""
@@ -108,31 +153,43 @@ def setup_website_dir(env: jinja2.environment.Environment,
     _mkdir(os.path.join(path, 'api', '1'))
     _mkdir(os.path.join(path, 'api', '1', 'player'))
     _mkdir(os.path.join(path, 'api', '1', 'player', 'wins'))
+    _mkdir(os.path.join(path, 'api', '2'))
+    _mkdir(os.path.join(path, 'api', '2', 'player'))
 
-    print("Copying static assets")
-    src = os.path.join(os.path.dirname(__file__), 'html_static')
-    dst = os.path.join(path, 'static')
-    if sys.platform != 'win32':
-        subprocess.run(['rsync', '-a', src + '/', dst + '/'])
-    else:
-        rsync_replacement(src, dst)
+    _mkdir(os.path.join(path, 'static'))
+    _mkdir(os.path.join(path, 'static', 'css'))
+    _mkdir(os.path.join(path, 'static', 'js'))
+    _mkdir(os.path.join(path, 'static', 'images'))
+    _mkdir(os.path.join(path, 'static', 'players'))
 
-    print("Generating player list")
-    _write_file(
-        path=os.path.join(dst, 'js', 'players.json'),
-        data=json.dumps([p.name for p in all_players]))
+    assets.install(env, assets.build_assets(env, writer))
 
-    print("Writing minified local JS")
-    js_template = env.get_template('dcss-scoreboard.js')
-    _write_file(
-        path=os.path.join(WEBSITE_DIR, 'static/js/dcss-scoreboard.js'),
-        data=jsmin.jsmin(js_template.render()))
+    playerindex.write_player_index(writer, [p.name for p in all_players])
 
 
-def render_index(s: sqlalchemy.orm.session.Session,
-                 template: jinja2.environment.Template) -> str:
-    """Render the index page."""
-    return template.render(
+def _write_page(env: jinja2.environment.Environment,
+                writer: sitewriter.SiteWriter,
+                report: buildreport.BuildReport,
+                name: str,
+                context: Callable[[], dict]) -> None:
+    """Render and write a top level page, eg 'index'.
+
+    Parameters:
+        context: runs the page's queries, returning the template context
+    """
+    template = env.get_template('%s.html' % name)
+    with report.timed(name, 'query'):
+        data = context()
+    with report.timed(name, 'render'):
+        page = template.render(**data)
+    with report.timed(name, 'write'):
+        writer.write('%s.html' % name, page)
+    report.page(name)
+
+
+def index_context(s: sqlalchemy.orm.session.Session) -> dict:
+    """Return the index page's template context."""
+    return dict(
         recent_wins=model.list_games(
             s, winning=True, limit=const.FRONTPAGE_TABLE_LENGTH),
         active_streaks=[],
@@ -143,148 +200,133 @@ def render_index(s: sqlalchemy.orm.session.Session,
 
 
 def write_index(s: sqlalchemy.orm.session.Session,
-                env: jinja2.environment.Environment) -> None:
+                env: jinja2.environment.Environment,
+                writer: sitewriter.SiteWriter,
+                report: buildreport.BuildReport) -> None:
     """Write the index page."""
     print("Writing index")
-    template = env.get_template('index.html')
-    data = render_index(s, template)
-    _write_file(path=os.path.join(WEBSITE_DIR, 'index.html'), data=data)
+    _write_page(env, writer, report, 'index', lambda: index_context(s))
 
 
-def write_404(env: jinja2.environment.Environment) -> None:
+def write_404(env: jinja2.environment.Environment,
+              writer: sitewriter.SiteWriter,
+              report: buildreport.BuildReport) -> None:
     """Write the 404 page."""
     print("Writing 404")
-    template = env.get_template('404.html')
-    _write_file(
-        path=os.path.join(WEBSITE_DIR, '404.html'), data=template.render())
+    _write_page(env, writer, report, '404', dict)
 
 
 def write_streaks(s: sqlalchemy.orm.session.Session,
-                  env: jinja2.environment.Environment) -> None:
+                  env: jinja2.environment.Environment,
+                  writer: sitewriter.SiteWriter,
+                  report: buildreport.BuildReport) -> None:
     """Write the streak page."""
     print("Writing streaks")
-    template = env.get_template('streaks.html')
-    active_streaks = model.get_streaks(s, active=True, max_age=365)
-    best_streaks = model.get_streaks(s, limit=10)
-    _write_file(
-        path=os.path.join(WEBSITE_DIR, 'streaks.html'),
-        data=template.render(
-            active_streaks=active_streaks, best_streaks=best_streaks))
-
-
-def render_highscores(s: sqlalchemy.orm.session.Session,
-                      template: jinja2.environment.Template) -> str:
-    """Render the highscores page."""
-    overall_highscores = model.highscores(s)
-    species_highscores = model.species_highscores(s)
-    background_highscores = model.background_highscores(s)
-    god_highscores = model.god_highscores(s)
-    combo_highscores = model.combo_highscores(s)
-    fastest_wins = model.fastest_wins(s, exclude_bots=True)
-    shortest_wins = model.shortest_wins(s)
-    return template.render(
-        overall_highscores=overall_highscores,
-        species_highscores=species_highscores,
-        background_highscores=background_highscores,
-        god_highscores=god_highscores,
-        combo_highscores=combo_highscores,
-        fastest_wins=fastest_wins,
-        shortest_wins=shortest_wins)
+    _write_page(env, writer, report, 'streaks', lambda: dict(
+        active_streaks=model.get_streaks(s, active=True, max_age=365),
+        best_streaks=model.get_streaks(s, limit=10)))
+
+
+def highscores_context(s: sqlalchemy.orm.session.Session) -> dict:
+    """Return the highscores page's template context."""
+    return dict(
+        overall_highscores=model.highscores(s),
+        species_highscores=model.species_highscores(s),
+        background_highscores=model.background_highscores(s),
+        god_highscores=model.god_highscores(s),
+        combo_highscores=model.combo_highscores(s),
+        fastest_wins=model.fastest_wins(s, exclude_bots=True),
+        shortest_wins=model.shortest_wins(s))
 
 
 def write_highscores(s: sqlalchemy.orm.session.Session,
-                     env: jinja2.environment.Environment) -> None:
+                     env: jinja2.environment.Environment,
+                     writer: sitewriter.SiteWriter,
+                     report: buildreport.BuildReport) -> None:
     """Write the highscores page."""
     print("Writing highscores")
-    template = env.get_template('highscores.html')
-    data = render_highscores(s, template)
-    _write_file(path=os.path.join(WEBSITE_DIR, 'highscores.html'), data=data)
-
-
-def _get_player_records(global_records: dict, player: orm.Player) -> dict:
-    out = {}  # type: dict
-    for typ, games in global_records.items():
-        for game in games:
-            if game.player.name == player:
-                if typ not in out:
-                    out[typ] = [game]
-                else:
-                    out[typ].append(game)
-    return out
+    _write_page(env, writer, report, 'highscores',
+                lambda: highscores_context(s))
 
 
-def _wins_per_species(s: sqlalchemy.orm.session.Session,
-                      games: Iterable[orm.Game],
-                      playable: bool=True) -> Iterable[orm.Game]:
-    """Return a dict of form {<Species 'Ce'>: [winning_game, ...}, ...}."""
-    out = collections.OrderedDict()  # type: dict
-    for sp in model.list_species(s, playable=playable):
-        matching_games = [g for g in games if g.won and g.species == sp]
-        # For playable=True, add every species to the output.
-        # For playable=False, only add ones with wins
-        if playable or matching_games:
-            out[sp] = matching_games
-    return out
+# Win breakdowns on player pages: name -> (Game id column, lister)
+WIN_CATEGORIES = (
+    ('species', 'species_id', model.list_species),
+    ('background', 'background_id', model.list_backgrounds),
+    ('god', 'god_id', model.list_gods), )
 
 
-def _wins_per_background(s: sqlalchemy.orm.session.Session,
-                         games: Iterable[orm.Game],
-                         playable: bool=True) -> Iterable[orm.Game]:
-    """Return a dict of form {<Background 'Be'>: [winning_game, ...}, ...}."""
-    out = collections.OrderedDict()  # type: dict
-    for bg in model.list_backgrounds(s, playable=playable):
-        matching_games = [g for g in games if g.won and g.background == bg]
-        # For playable=True, add every background to the output.
-        # For playable=False, only add ones with wins
-        if playable or matching_games:
-            out[bg] = matching_games
-    return out
+def win_categories(s: sqlalchemy.orm.session.Session) -> dict:
+    """Return the categories used by player page win breakdowns.
+
+    Returns a dict of form {'species': (playable, unplayable), ...}. This is
+    built once per website build and shared by every player page.
+    """
+    return {
+        name: (lister(s, playable=True), lister(s, playable=False))
+        for name, _, lister in WIN_CATEGORIES
+    }
+
 
+def _wins_breakdown(games: Iterable[orm.Game], categories: dict) -> dict:
+    """Group winning games by species, background and god in one pass.
 
-def _wins_per_god(s: sqlalchemy.orm.session.Session,
-                  games: Iterable[orm.Game],
-                  playable: bool=True) -> Iterable[orm.Game]:
-    """Return a dict of form {<God 'Beogh'>: [winning_game, ...}, ...}."""
-    out = collections.OrderedDict()  # type: dict
-    for god in model.list_gods(s, playable=playable):
-        matching_games = [g for g in games if g.won and g.god == god]
-        # For playable=True, add every god to the output.
-        # For playable=False, only add ones with wins
-        if playable or matching_games:
-            out[god] = matching_games
+    Returns a dict of form
+    {'species': ({<Species 'Ce'>: [winning_game, ...], ...}, {...}), ...}
+    with the playable and unplayable breakdowns for each category. Every
+    playable category is included, unplayable ones only if they have wins.
+    """
+    by_id = {name: collections.defaultdict(list)
+             for name, _, _ in WIN_CATEGORIES}  # type: dict
+    for game in games:
+        if not game.won:
+            continue
+        for name, column, _ in WIN_CATEGORIES:
+            by_id[name][getattr(game, column)].append(game)
+    out = {}
+    for name, _, _ in WIN_CATEGORIES:
+        wins = by_id[name]
+        playable, unplayable = categories[name]
+        out[name] = (
+            collections.OrderedDict((c, wins.get(c.id, []))
+                                    for c in playable),
+            collections.OrderedDict((c, wins[c.id]) for c in unplayable
+                                    if c.id in wins), )
     return out
 
 
-def render_player_page(s: sqlalchemy.orm.session.Session,
-                       template: jinja2.environment.Template,
+def render_player_page(template: jinja2.environment.Template,
                        player: orm.Player,
-                       global_records: dict) -> str:
-    """Render an individual player's page."""
-    n_games = model.count_games(s, player=player)
+                       data: Optional[dict],
+                       records: dict,
+                       categories: dict) -> str:
+    """Render an individual player's page.
+
+    Parameters:
+        data: the player's entry from model.player_page_data, or None if
+            they have no games
+        records: the player's entry from model.get_gobal_records
+        categories: from win_categories
+    """
     # Don't make pages for players with no games played
-    if n_games == 0:
+    if data is None:
         return ''
 
-    # XXX: potential memory hog
-    won_games = model.list_games(s, player=player, winning=True)
+    won_games = data['won_games']
     n_won_games = len(won_games)
-    species_wins = _wins_per_species(s, won_games)
-    unplayable_species_wins = _wins_per_species(s, won_games, playable=False)
-    background_wins = _wins_per_background(s, won_games)
-    unplayable_background_wins = _wins_per_background(
-        s, won_games, playable=False)
-    god_wins = _wins_per_god(s, won_games)
-    unplayable_god_wins = _wins_per_god(s, won_games, playable=False)
+    wins = _wins_breakdown(won_games, categories)
+    species_wins, unplayable_species_wins = wins['species']
+    background_wins, unplayable_background_wins = wins['background']
+    god_wins, unplayable_god_wins = wins['god']
     shortest_win = min(won_games, default=None, key=lambda g: g.turn)
     fastest_win = min(won_games, default=None, key=lambda g: g.dur)
 
-    records = _get_player_records(global_records, player)
-    active_streak = model.get_player_streak(s, player)
-    n_boring_games = model.count_games(s, player=player, boring=True)
-    total_dur = model.total_duration(s, player=player)
-    highscore = model.highscores(s, player=player, limit=1)[0]
-    recent_games = model.list_games(
-        s, player=player, limit=const.PLAYER_TABLE_LENGTH)
+    active_streak = data['active_streak']
+    n_games = data['n_games']
+    n_boring_games = data['n_boring_games']
+    total_dur = data['total_dur']
+    highscore = data['highscore']
+    recent_games = data['recent_games']
 
     return template.render(
         player=player,
@@ -307,98 +349,397 @@ def render_player_page(s: sqlalchemy.orm.session.Session,
         won_games=won_games)
 
 
-def write_player_page(player_html_path: str, name: str, data: str) -> None:
+def write_player_page(writer: sitewriter.SiteWriter, name: str,
+                      data: str) -> None:
     """Write an individual player's page."""
-    _write_file(path=os.path.join(player_html_path, name + '.html'), data=data)
+    writer.write('players/%s.html' % name, data)
+
+
+# (player id, url name, page, query secs, render secs, number of games)
+RenderedPage = Tuple[int, str, str, float, float, int]
+
+
+def render_player_pages(s: sqlalchemy.orm.session.Session,
+                        template: jinja2.environment.Template,
+                        players: Sequence[orm.Player],
+                        records: dict,
+                        categories: dict) \
+        -> Iterator[RenderedPage]:
+    """Render a group of player pages from one batch of queries.
+
+    Parameters:
+        players: the group of players, see model.player_page_data
+        records: from model.get_gobal_records (or _load_records)
+        categories: from win_categories
+
+    Yields a RenderedPage for each player. The time spent fetching the
+    group's data is split evenly between them.
+    """
+    start = time.time()
+    data = model.player_page_data(s, [p.id for p in players])
+    query_time = (time.time() - start) / max(len(players), 1)
+    for player in players:
+        player_data = data.get(player.id)
+        start = time.time()
+        page = render_player_page(template, player, player_data,
+                                  records.get(player.id, {}), categories)
+        yield (player.id, player.url_name, page, query_time,
+               time.time() - start,
+               player_data['n_games'] if player_data else 0)
+
+
+def _groups(items: Sequence, size: int) -> Iterator[Sequence]:
+    """Split items into consecutive groups of up to size items."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _records_gids(global_records: dict) -> dict:
+    """Convert model.get_gobal_records output to gids, for worker processes.
+
+    Returns a dict of form {player_id: {board: [gid, ...]}}.
+    """
+    return {
+        player_id: {board: [g.gid for g in games]
+                    for board, games in boards.items()}
+        for player_id, boards in global_records.items()
+    }
+
+
+def _load_records(s: sqlalchemy.orm.session.Session,
+                  records: dict,
+                  player_ids: Sequence[int]) -> dict:
+    """Load the record games of some players from _records_gids output.
+
+    Returns a dict in the same form as model.get_gobal_records.
+    """
+    records = {pid: records[pid] for pid in player_ids if pid in records}
+    gids = set(gid
+               for boards in records.values() for board in boards.values()
+               for gid in board)
+    if not gids:
+        return {}
+    games = {
+        g.gid: g
+        for g in s.query(orm.Game).filter(orm.Game.gid.in_(gids))
+    }
+    return {
+        pid: {board: [games[gid] for gid in board_gids]
+              for board, board_gids in boards.items()}
+        for pid, boards in records.items()
+    }
+
+
+# Per-process state for player page render workers
+_worker = {}  # type: dict
+
+
+def _init_render_worker(database_options: dict, urlbase: str,
+                        records: dict) -> None:
+    """Connect a render worker to the database and set up templates.
+
+    Parameters:
+        database_options: orm.DATABASE_OPTIONS from the parent process
+        urlbase: the website base URL
+        records: from _records_gids
+    """
+    orm.setup_database(**database_options)
+    s = orm.get_session(readonly=True)
+    _worker['session'] = s
+    env = jinja_env(urlbase, s)
+    assets.install(env, assets.load_assets(WEBSITE_DIR))
+    _worker['template'] = env.get_template('player.html')
+    _worker['categories'] = win_categories(s)
+    _worker['records'] = records
+
+
+def _render_players_worker(task: Tuple[Sequence[int], Optional[float]]) \
+        -> Sequence[RenderedPage]:
+    """Render a group of player pages in a worker process.
+
+    Parameters:
+        task: (player ids, deadline). If deadline has passed, nothing is
+            rendered.
+
+    Returns a list of render_player_pages results.
+    """
+    player_ids, deadline = task
+    if deadline is not None and time.time() > deadline:
+        return []
+    s = _worker['session']
+    players = s.query(orm.Player).filter(orm.Player.id.in_(player_ids)).all()
+    records = _load_records(s, _worker['records'], player_ids)
+    return list(
+        render_player_pages(s, _worker['template'], players, records,
+                            _worker['categories']))
+
+
+def _render_players_serial(s: sqlalchemy.orm.session.Session,
+                           env: jinja2.environment.Environment,
+                           players: Sequence,
+                           global_records: dict,
+                           deadline: Optional[float]=None) \
+        -> Iterator[RenderedPage]:
+    """Render player pages in this process, like _render_players_worker."""
+    categories = win_categories(s)
+    template = env.get_template('player.html')
+    for i, group in enumerate(_groups(players, PLAYER_PAGE_GROUP_SIZE)):
+        if i and deadline is not None and time.time() > deadline:
+            return
+        yield from render_player_pages(s, template, group, global_records,
+                                       categories)
+
+
+def _render_players_parallel(s: sqlalchemy.orm.session.Session,
+                             env: jinja2.environment.Environment,
+                             players: Sequence,
+                             global_records: dict,
+                             workers: int,
+                             deadline: Optional[float]=None) \
+        -> Iterator[RenderedPage]:
+    """Render player pages in a pool of worker processes.
+
+    Each worker has its own database connection and Jinja environment. The
+    global records are computed once here and passed to every worker.
+    """
+    records = _records_gids(global_records)
+    # Compile the template once, workers load it from the template cache
+    env.get_template('player.html')
+    # spawn rather than fork, so workers don't inherit database connections
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(
+            workers,
+            initializer=_init_render_worker,
+            initargs=(orm.DATABASE_OPTIONS, env.globals['urlbase'],
+                      records)) as pool:
+        player_ids = [p.id for p in players]
+        # The first group is always rendered, so every run makes progress
+        tasks = ((group, deadline if i else None) for i, group in enumerate(
+            _groups(player_ids, PLAYER_PAGE_GROUP_SIZE)))
+        for pages in pool.imap_unordered(_render_players_worker, tasks):
+            yield from pages
+
+
+def _player_pages_written(player_ids: Sequence[int],
+                          dirty: Dict[int, datetime.datetime]) -> None:
+    """Record player pages as updated and remove them from the queue."""
+    # The render session may be read-only, so use a separate one
+    ws = orm.get_session()
+    model.updated_player_pages(ws, player_ids)
+    model.remove_dirty_pages(ws, [(model.player_page_key(pid), dirty[pid])
+                                  for pid in player_ids if pid in dirty])
+    ws.commit()
 
 
 def write_player_pages(s: sqlalchemy.orm.session.Session,
                        env: jinja2.environment.Environment,
-                       players: Sequence) -> None:
-    """Write all player pages."""
+                       writer: sitewriter.SiteWriter,
+                       players: Sequence,
+                       global_records: dict,
+                       dirty: Dict[int, datetime.datetime],
+                       report: buildreport.BuildReport,
+                       workers: int=1,
+                       deadline: Optional[float]=None) -> List[int]:
+    """Write player pages, in order.
+
+    Parameters:
+        global_records: from model.get_gobal_records
+        dirty: {player id: enqueued_at} of their dirty_pages entries,
+            which are removed as pages are written
+        report: each page's timings are added to this
+        workers: if more than 1, render pages in this many processes
+        deadline: if specified, stop starting new groups of pages once
+            time.time() passes this (the first group is always written)
+
+    Returns the ids of the players whose pages were written.
+    """
     print("Writing %s player pages... " % len(players))
     start2 = time.time()
     player_html_path = os.path.join(WEBSITE_DIR, 'players')
     if not os.path.exists(player_html_path):
         os.mkdir(player_html_path)
-    global_records = model.get_gobal_records(s)
-    template = env.get_template('player.html')
 
-    n = 0
-    for player in players:
-        data = render_player_page(s, template, player, global_records)
-        write_player_page(player_html_path, player.url_name, data)
-        model.updated_player_page(s, player)
-        n += 1
-        if not n % 100:
-            print(n)
-    s.commit()
+    if workers > 1 and len(players) > 1:
+        pages = _render_players_parallel(s, env, players, global_records,
+                                         workers, deadline)
+    else:
+        pages = _render_players_serial(s, env, players, global_records,
+                                       deadline)
+    updated = []
+    unrecorded = []  # type: List[int]
+    for player_id, url_name, data, query, render, n_games in pages:
+        write_start = time.time()
+        write_player_page(writer, url_name, data)
+        report.player_page(
+            url_name,
+            games=n_games,
+            query=query,
+            render=render,
+            write=time.time() - write_start)
+        updated.append(player_id)
+        if not len(updated) % 100:
+            print(len(updated))
+        unrecorded.append(player_id)
+        if len(unrecorded) >= PLAYER_PAGE_COMMIT_SIZE:
+            _player_pages_written(unrecorded, dirty)
+            unrecorded = []
+    _player_pages_written(unrecorded, dirty)
+    if len(updated) < len(players):
+        print("Player page time budget used up after %s pages" %
+              len(updated))
     end = time.time()
     print("Wrote player pages in %s seconds" % round(end - start2, 2))
+    return updated
 
 
 def write_player_api(s: sqlalchemy.orm.session.Session,
                      env: jinja2.environment.Environment,
+                     writer: sitewriter.SiteWriter,
                      players: Sequence) -> None:
     """Write all player API pages."""
     print("Writing player API pages")
     for player in players:
-        won_games = model.list_games(s, player=player, winning=True)
-        data = json.dumps(
-            [g.as_dict() for g in won_games], sort_keys=True, indent=2)
-        path = os.path.join(WEBSITE_DIR, 'api', '1', 'player', 'wins',
-                            player.url_name)
-        _write_file(path=path, data=data)
+        won_games = model.iter_games(s, player=player, winning=True)
+        _write_json_list(
+            writer=writer,
+            path='api/1/player/wins/%s' % player.url_name,
+            items=(g.as_dict() for g in won_games))
 
 
 def write_website(players: Optional[Iterable],
                   urlbase: str,
-                  extra_player_pages: int) -> None:
+                  extra_player_pages: int,
+                  render_workers: int=1,
+                  precompress: bool=False,
+                  compress_workers: int=1,
+                  page_budget: Optional[float]=None,
+                  report_path: Optional[str]=BUILD_REPORT,
+                  history_path: Optional[str]=None,
+                  fragment_cache_dir: Optional[str]=FRAGMENT_CACHE_DIR) \
+        -> None:
     """Write all website files.
 
     Paramers:
         urlbase (str) Base URL for the website
-        players (iterable of strings) Only write these player pages.
+        players (iterable of strings) Also write these player pages.
             Pass in the player's name, not the entire Player object.
             If you pass in None, all player pages will be rebuilt.
-            If you pass in any other false value, no player pages will be
-              rebuilt.
+            Otherwise, the pages queued in dirty_pages and
+            extra_player_pages stale pages are written, see
+            scoreboard.schedule.
+        extra_player_pages (int) Also write this many of the least
+            recently updated player pages
+        render_workers (int) Render player pages in this many processes
+        precompress (bool) Also write .gz (and .br) copies of changed files
+        compress_workers (int) Compress files in this many processes
+        page_budget (float) Stop rendering player pages after this many
+            seconds. Queued pages which are left stay in the queue for the
+            next run.
+        report_path (str) Write a timing report of the build here, see
+            scoreboard.buildreport
+        history_path (str) Also append the timing report to this file
+        fragment_cache_dir (str) Save the index, highscores and streaks
+            tables here for later builds, None to disable
     """
     start = time.time()
-
-    s = orm.get_session()
-
-    env = jinja_env(urlbase, s)
-
-    # We need the list of all players to generate players.json
-    all_players = sorted(model.list_players(s), key=lambda p: p.name)
-
-    # Figure out what player pages to generate
-    if players is None:
-        players = all_players
-    else:
-        if not players:
-            players = []
+    report = buildreport.BuildReport()
+    full_rebuild = players is None
+
+    s = orm.get_session(readonly=True)
+
+    with report.stage('setup'):
+        env = jinja_env(urlbase, s, fragment_cache_dir)
+
+        # We need the list of all players to generate the player index
+        all_players = sorted(model.list_players(s), key=lambda p: p.name)
+
+        global_records = model.get_gobal_records(s)
+        holders = schedule.record_holders(global_records)
+
+    # Figure out what player pages to generate. The queue is read and
+    # written in the primary database, s may be a read-only replica.
+    with report.stage('schedule'):
+        qs = orm.get_session()
+        schedule.enqueue_record_changes(qs, WEBSITE_DIR, holders)
+        if players:
+            schedule.enqueue_players(qs, players)
+        if full_rebuild:
+            scheduled = schedule.schedule_all_players(
+                qs, [p.id for p in all_players])
         else:
-            players = [model.get_player(s, p) for p in players]
-        if extra_player_pages:
-            extra_players = model.get_old_player_pages(s, extra_player_pages)
-            players.extend(p for p in extra_players if p not in players)
-    # Randomise order
-    random.shuffle(players)
-
-    setup_website_dir(env, WEBSITE_DIR, all_players)
-
-    write_index(s, env)
-
-    write_404(env)
-
-    write_streaks(s, env)
-
-    write_highscores(s, env)
-
-    write_player_pages(s, env, players)
-
-    write_player_api(s, env, players)
+            scheduled = schedule.schedule_player_pages(
+                qs, extra=extra_player_pages)
+        qs.commit()
+        _mkdir(WEBSITE_DIR)
+        schedule.save_record_holders(WEBSITE_DIR, holders)
+    # Players added since s was opened are left in the queue for next time
+    players_by_id = {p.id: p for p in all_players}
+    players = [
+        players_by_id[pid] for pid, _, _ in scheduled if pid in players_by_id
+    ]
+    dirty = {
+        pid: enqueued_at
+        for pid, _, enqueued_at in scheduled if enqueued_at is not None
+    }
+
+    writer = sitewriter.SiteWriter(
+        WEBSITE_DIR, compress=precompress, workers=compress_workers)
+    with report.stage('static'):
+        setup_website_dir(env, writer, WEBSITE_DIR, all_players)
+
+    with report.stage('index'):
+        write_index(s, env, writer, report)
+
+    with report.stage('404'):
+        write_404(env, writer, report)
+
+    with report.stage('streaks'):
+        write_streaks(s, env, writer, report)
+
+    with report.stage('highscores'):
+        write_highscores(s, env, writer, report)
+
+    deadline = None
+    if page_budget is not None:
+        deadline = time.time() + page_budget
+    with report.stage('player pages'):
+        updated = write_player_pages(
+            s,
+            env,
+            writer,
+            players,
+            global_records,
+            dirty,
+            report,
+            workers=render_workers,
+            deadline=deadline)
+
+    updated_ids = set(updated)
+    updated_players = [p for p in players if p.id in updated_ids]
+    with report.stage('player api v1'):
+        write_player_api(s, env, writer, updated_players)
+
+    # Only a full rebuild checks every player's history pages
+    with report.stage('player api v2'):
+        playerapi.write_player_api(
+            s, writer, all_players if full_rebuild else updated_players)
+
+    with report.stage('save'):
+        writer.save()
+    print("Wrote %s changed files, %s unchanged, %s removed" %
+          (writer.written, writer.unchanged, writer.removed))
+
+    pruned = webutils.prune_fragment_cache(FRAGMENT_MAX_AGE)
+    if pruned:
+        print("Pruned %s unused tables from %s" % (pruned,
+                                                   fragment_cache_dir))
+
+    report.finish()
+    print(report.summary())
+    if report_path:
+        report.save(report_path)
+        print("Wrote build report to %s" % report_path)
+    if history_path:
+        report.append_to(history_path)
 
     print("Wrote website in %s seconds" % round(time.time() - start, 2))
@@ -1,13 +1,305 @@
-import http.server
-import socketserver
+#!/usr/bin/env python3
+"""Serve the website directory over HTTP, without needing nginx.
+
+Requests are handled in threads, so a slow client doesn't block anyone
+else. Like contrib/nginx.conf, the server:
+* serves the .br/.gz copies written by loader.py --precompress to clients
+  which accept them,
+* sends ETags (from the content hashes in the website's manifest, see
+  scoreboard/sitewriter.py) and answers If-None-Match/If-Modified-Since
+  with 304s,
+* lets browsers cache fingerprinted assets (see scoreboard/assets.py)
+  forever, and other files briefly.
+Files are sent with sendfile where the OS supports it.
+"""
+
 import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import threading
+import mimetypes
+import socketserver
+import http.server
+import email.utils
+import urllib.parse
+from typing import IO, Dict, List, Optional, Tuple
+
+import scoreboard.sitewriter
 
 PORT = 8000
+WEBSITE_DIR = 'website'
+
+# (path pattern, Cache-Control value), first match wins. Matches the
+# expiry times in contrib/nginx.conf.
+CACHE_RULES = (
+    (re.compile(r'\.[0-9a-f]{10}\.(css|js|png)$', re.I),
+     'public, max-age=31536000, immutable'),
+    (re.compile(r'\.(css|js|png)$', re.I), 'max-age=3600'), )
+# Everything else (pages and API files) changes with each build
+DEFAULT_CACHE_CONTROL = 'max-age=60'
+
+# (Content-Encoding, file suffix), most preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Smaller files are copied through the socket's write buffer
+SENDFILE_MIN_SIZE = 64 * 1024
+
+
+class Manifest:
+    """The content hashes of the website's files, reloaded when it changes.
+
+    Parameters:
+        root: the website dir
+    """
+
+    def __init__(self, root: str) -> None:
+        self.path = os.path.join(root, scoreboard.sitewriter.MANIFEST)
+        self._lock = threading.Lock()
+        self._mtime = None  # type: Optional[float]
+        self._hashes = {}  # type: Dict[str, str]
+
+    def get(self, path: str) -> Optional[str]:
+        """Return the content hash of a file (relative to root), if known."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            if mtime != self._mtime:
+                try:
+                    with open(self.path, encoding='utf8') as f:
+                        self._hashes = json.load(f)
+                except (OSError, ValueError):
+                    self._hashes = {}
+                self._mtime = mtime
+            return self._hashes.get(path)
+
+
+def accepted_encodings(header: Optional[str]) -> List[str]:
+    """Return the content codings an Accept-Encoding header allows."""
+    accepted = []
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            accepted.append(coding.strip().lower())
+    return accepted
+
+
+def cache_control(path: str) -> str:
+    """Return the Cache-Control header for a path."""
+    for pattern, value in CACHE_RULES:
+        if pattern.search(path):
+            return value
+    return DEFAULT_CACHE_CONTROL
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Check an If-None-Match header (weak comparison, as per RFC 7232)."""
+    if header.strip() == '*':
+        return True
+    tags = [t.strip() for t in header.split(',')]
+    return etag in (t[2:] if t.startswith('W/') else t for t in tags)
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    """Serve files from the current directory with caching headers."""
+
+    protocol_version = 'HTTP/1.1'
+    manifest = None  # type: Manifest
+
+    def _relative_path(self) -> str:
+        path = urllib.parse.unquote(
+            urllib.parse.urlsplit(self.path).path)
+        return path.lstrip('/')
+
+    def _find_file(self, path: str) -> Tuple[Optional[str], str]:
+        """Return (file to serve or None if not found, relative path).
+
+        Parameters:
+            path: the request's filesystem path, from translate_path
+        """
+        rel = self._relative_path()
+        if os.path.isdir(path):
+            rel = rel.rstrip('/') + '/index.html' if rel else 'index.html'
+            path = os.path.join(path, 'index.html')
+        # Hidden files are the manifest and in-progress temp files
+        if any(part.startswith('.') for part in rel.split('/')) or \
+                not os.path.isfile(path):
+            return None, rel
+        return path, rel
+
+    def _content_type(self, rel: str) -> str:
+        if rel.startswith('api/') and not os.path.splitext(rel)[1]:
+            return 'application/json'
+        ctype = mimetypes.guess_type(rel)[0] or 'application/octet-stream'
+        if ctype.startswith('text/') or ctype in ('application/javascript',
+                                                  'application/json'):
+            ctype += '; charset=utf-8'
+        return ctype
+
+    def _redirect_to_directory(self) -> None:
+        parts = urllib.parse.urlsplit(self.path)
+        location = urllib.parse.urlunsplit(
+            (parts[0], parts[1], parts[2] + '/', parts[3], parts[4]))
+        self.send_response(301)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _send_404(self) -> Optional[IO[bytes]]:
+        """Send the website's 404 page, or a plain error without one."""
+        path = os.path.join(os.getcwd(), '404.html')
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+        f = open(path, 'rb')
+        self.send_response(404)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        return f
+
+    def _choose_encoding(self, path: str) -> Tuple[str, Optional[str], bool]:
+        """Pick the copy of a file to send.
+
+        Returns (filesystem path, Content-Encoding or None, whether any
+        compressed copies exist).
+        """
+        accepted = accepted_encodings(self.headers.get('Accept-Encoding'))
+        variants = [(coding, path + suffix) for coding, suffix in ENCODINGS
+                    if os.path.isfile(path + suffix)]
+        for coding, variant in variants:
+            if coding in accepted:
+                return variant, coding, True
+        return path, None, bool(variants)
+
+    def _etag(self, rel: str, encoding: Optional[str],
+              stat: os.stat_result) -> str:
+        digest = self.manifest.get(rel)
+        if digest is None:
+            digest = '%x-%x' % (int(stat.st_mtime), stat.st_size)
+        if encoding:
+            digest += '-' + encoding
+        return '"%s"' % digest
+
+    def _not_modified(self, etag: str, mtime: float) -> bool:
+        """Check the request's conditional headers."""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return _etag_matches(if_none_match, etag)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def send_head(self) -> Optional[IO[bytes]]:
+        """Send the response headers, returning the file to send or None."""
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and \
+                not urllib.parse.urlsplit(self.path).path.endswith('/'):
+            self._redirect_to_directory()
+            return None
+        path, rel = self._find_file(path)
+        if path is None:
+            return self._send_404()
+
+        send_path, encoding, has_variants = self._choose_encoding(path)
+        try:
+            f = open(send_path, 'rb')
+        except OSError:
+            return self._send_404()
+        stat = os.fstat(f.fileno())
+        etag = self._etag(rel, encoding, stat)
+        not_modified = self._not_modified(etag, stat.st_mtime)
+
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified',
+                         self.date_time_string(int(stat.st_mtime)))
+        self.send_header('Cache-Control', cache_control(rel))
+        if has_variants:
+            self.send_header('Vary', 'Accept-Encoding')
+        if not_modified:
+            self.end_headers()
+            f.close()
+            return None
+        self.send_header('Content-Type', self._content_type(rel))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(stat.st_size))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source: IO[bytes], outputfile: IO[bytes]) -> None:
+        """Send a file's content, with sendfile for large files."""
+        size = os.fstat(source.fileno()).st_size
+        if size < SENDFILE_MIN_SIZE:
+            shutil.copyfileobj(source, outputfile)
+            return
+        outputfile.flush()
+        self.connection.sendfile(source)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    """Handle each connection in its own thread."""
+
+    daemon_threads = True
+
+
+def serve(root: str, port: int=PORT, bind: str='') -> None:
+    """Serve root at http://bind:port/ until interrupted."""
+    os.chdir(root)
+    Handler.manifest = Manifest('.')
+    httpd = ThreadingHTTPServer((bind, port), Handler)
+    print("Serving %s at port %s" % (root, port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
 
-Handler = http.server.SimpleHTTPRequestHandler
+def main() -> None:
+    """Run CLI."""
+    parser = argparse.ArgumentParser(description="Serve the website.")
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=PORT,
+        help="Port to listen on. Default: %(default)s")
+    parser.add_argument(
+        '--bind',
+        metavar='ADDRESS',
+        default='',
+        help="Address to listen on. Default: all interfaces")
+    parser.add_argument(
+        '--root',
+        metavar='DIR',
+        default=WEBSITE_DIR,
+        help="Website directory to serve. Default: %(default)s")
+    args = parser.parse_args()
+    if not os.path.isdir(args.root):
+        print("%s doesn't exist, write the website first" % args.root,
+              file=sys.stderr)
+        sys.exit(1)
+    serve(args.root, args.port, args.bind)
 
-httpd = socketserver.TCPServer(("", PORT), Handler)
-os.chdir('website')
 
-print("Serving at port", PORT)
-httpd.serve_forever()
+if __name__ == '__main__':
+    main()
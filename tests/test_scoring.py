@@ -0,0 +1,85 @@
+"""Tests for scoreboard.scoring."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import scoreboard.orm as orm
+import scoreboard.model as model
+import scoreboard.scoring as scoring
+import scoreboard.log_import as log_import
+
+
+def _api_game(i: int, name: str, ktyp: str) -> dict:
+    """Return a game as returned by the logfile API."""
+    return {
+        'src_abbr': 'cao',
+        'data': {
+            'lv': '0.1',
+            'v': '0.19.1',
+            'name': name,
+            'char': 'MiFi',
+            'race': 'Minotaur',
+            'god': 'Okawaru',
+            'br': 'D',
+            'lvl': 1,
+            'xl': 1,
+            'turn': 10000 + i,
+            'dur': 5000 + i,
+            'sc': 100 + i,
+            'start': '2016010%d000000S' % (i + 1),
+            'end': '2016010%d120000S' % (i + 1),
+            'ktyp': ktyp,
+            'tmsg': 'escaped with the Orb',
+            'urune': 3,
+        }
+    }
+
+
+class ScoreGamesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        orm.setup_database(
+            database='sqlite',
+            path=os.path.join(self.tmp, 'test.db3'),
+            credentials='')
+        s = orm.get_session()
+        # Wins start streaks, which are created partway through the batch
+        for i, (name, ktyp) in enumerate([('alice', 'winning'),
+                                          ('bob', 'winning'),
+                                          ('alice', 'mon'),
+                                          ('carol', 'quitting')]):
+            self.assertTrue(log_import.add_game(s, _api_game(i, name, ktyp)))
+        s.commit()
+        s.close()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp)
+
+    def test_failed_batch_leaves_games_unscored(self) -> None:
+        with unittest.mock.patch.object(
+                model, 'enqueue_dirty_pages', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                scoring.score_games()
+        s = orm.get_session()
+        self.assertEqual(s.query(orm.Game).count(), 4)
+        self.assertEqual(
+            s.query(orm.Game).filter(orm.Game.scored == True).count(), 0)
+        self.assertEqual(s.query(orm.Streak).count(), 0)
+
+    def test_scored_players_are_queued(self) -> None:
+        self.assertEqual(scoring.score_games(), {'alice', 'bob', 'carol'})
+        s = orm.get_session()
+        self.assertEqual(
+            s.query(orm.Game).filter(orm.Game.scored == False).count(), 0)
+        queued = {page for page, _, _ in model.get_dirty_pages(s, 'player:')}
+        self.assertEqual(queued, {
+            model.player_page_key(model.get_player_id(s, name))
+            for name in ('alice', 'bob', 'carol')
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()